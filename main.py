@@ -1,4 +1,5 @@
 import os
+import sys
 import argparse
 
 from loguru import logger
@@ -7,8 +8,19 @@ from mlflow import set_experiment
 from xtrainer import CONFIG, OS, VERSION, CUDA, TORCH_VERSION, TORCHVISION_VERSION
 from xtrainer.trainer import Trainer
 from xtrainer.predict import Predictor
+from xtrainer.benchmark import Benchmark
+from xtrainer.core.weights import export_inference_weights
 from xtrainer.utils.common import check_dir, get_time
 from xtrainer.utils.torch_utils import init_seeds, init_backends_cudnn
+from xtrainer.utils.dist import (
+    init_distributed,
+    destroy_distributed,
+    get_rank,
+    get_local_rank,
+    get_world_size,
+    is_main_process,
+    broadcast_object
+)
 
 
 def init_workspace() -> None:
@@ -20,24 +32,47 @@ def init_workspace() -> None:
             - weights(dir)
     """
 
-    check_dir(CONFIG['project'])
+    experiment_path = None
+    if is_main_process():
+        check_dir(CONFIG['project'])
 
-    experiment_path = os.path.join(CONFIG['project'], CONFIG['experiment'])
-    if os.path.exists(experiment_path):
-        experiment_path = os.path.join(CONFIG['project'], CONFIG['experiment'] + '.' + get_time())
-    check_dir(experiment_path)
+        experiment_path = os.path.join(CONFIG['project'], CONFIG['experiment'])
+        if os.path.exists(experiment_path):
+            experiment_path = os.path.join(CONFIG['project'], CONFIG['experiment'] + '.' + get_time())
+        check_dir(experiment_path)
+        check_dir(os.path.join(experiment_path, 'weights'))
 
+    # Distributed: every rank uses the experiment created by rank 0
+    experiment_path = broadcast_object(experiment_path)
     weight_path = os.path.join(experiment_path, 'weights')
-    check_dir(weight_path)
 
     CONFIG.update({"experiment_path": experiment_path})
     CONFIG.update({"weight_path": weight_path})
 
-    init_seeds(CONFIG['seed'])
+    # Different augment random streams per rank, the weights are synced by DDP
+    init_seeds(CONFIG['seed'] + get_rank())
     init_backends_cudnn(CONFIG['deterministic'])
 
 
+def init_dist() -> None:
+    # torchrun --nproc_per_node=N main.py --config ... (cuda:nccl, cpu:gloo)
+    use_cuda = CUDA and CONFIG['device'] >= 0
+    if not init_distributed(use_cuda):
+        return
+
+    CONFIG.update({'device': get_local_rank() if use_cuda else -1})
+
+    if not is_main_process():
+        logger.remove()
+        logger.add(sys.stderr, level='WARNING')
+
+    logger.info(f'Distributed: world_size={get_world_size()}, backend={"nccl" if use_cuda else "gloo"}.')
+
+
 def init_mlflow() -> None:
+    if not is_main_process():
+        return
+
     if CONFIG['mlflow_uri'] != -1:
         if CONFIG['mlflow_experiment_name'] == '':
             logger.info(f'MLFlow Experiment Name: Default.')
@@ -50,8 +85,8 @@ def init_mlflow() -> None:
 
 
 def check_args() -> None:
-    if CONFIG['mode'].lower() not in ['train', 'predict']:
-        raise KeyError("Model must be in ['train', 'predict']")
+    if CONFIG['mode'].lower() not in ['train', 'predict', 'export', 'bench']:
+        raise KeyError("Model must be in ['train', 'predict', 'export', 'bench']")
 
     if CONFIG['task'].lower() not in ['classification', 'segmentation', 'multitask']:
         raise KeyError("Model must be in ['classification', 'segmentation', 'multitask']")
@@ -84,6 +119,10 @@ def check_args() -> None:
             if CONFIG['segmentation.classes'] < len(CONFIG['seg_thr']):
                 raise EOFError('nc!=len(thr)')
 
+    if CONFIG['mode'] == 'export':
+        if os.path.exists(CONFIG['test_weight']) is False:
+            raise FileNotFoundError('Don`t found weight')
+
 
 if __name__ == '__main__':
     # Show Env Info ----------------------------------------------------------------------------------------------------
@@ -107,11 +146,31 @@ if __name__ == '__main__':
     check_args()
 
     if CONFIG['mode'].lower() == 'train':
+        init_dist()
         init_workspace()
         init_mlflow()
         trainer = Trainer()
-        # trainer.run()
+        trainer.run()
+        destroy_distributed()
 
     elif CONFIG['mode'].lower() == 'predict':
         predictor = Predictor()
         predictor.run()
+
+    elif CONFIG['mode'].lower() == 'export':
+        # training checkpoint -> .xtw inference weights (tensors + header, no optimizer state)
+        task = CONFIG['task'].lower()
+        save_path = export_inference_weights(
+            CONFIG['test_weight'],
+            CONFIG['export_weight'] or None,
+            CONFIG['wh'],
+            CONFIG['classification.labels'] if task in ['classification', 'multitask'] else None,
+            CONFIG['segmentation.labels'] if task in ['segmentation', 'multitask'] else None
+        )
+        logger.info(f'Export inference weights: {save_path}')
+
+    elif CONFIG['mode'].lower() == 'bench':
+        # synthetic data under <project>/bench.<time>, results in json
+        init_seeds(CONFIG['seed'])
+        benchmark = Benchmark()
+        benchmark.run()
@@ -0,0 +1,182 @@
+from typing import Optional, List, Tuple
+
+import torch
+
+# Batched augmentation: ops run on the whole collated batch (N,C,H,W) on the model device.
+# Every sample draws its own random parameters, the same as the per-sample cv2 ops in the dataloader workers.
+
+__all__ = [
+    'rgb_to_hsv',
+    'hsv_to_rgb',
+    'BatchToFloat',
+    'BatchRandomHSV',
+    'BatchRandomFlip',
+    'BatchNormalize',
+    'BatchToFloatNormalize'
+]
+
+
+def rgb_to_hsv(image: torch.Tensor) -> torch.Tensor:
+    """
+    image: (N,3,H,W) float in [0,1]
+    return: (N,3,H,W) h,s,v in [0,1]
+    """
+    r, g, b = image.unbind(1)
+    maxc, _ = image.max(1)
+    minc, _ = image.min(1)
+
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+
+    s = cr / torch.where(eqc, ones, maxc)
+
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def hsv_to_rgb(image: torch.Tensor) -> torch.Tensor:
+    """
+    image: (N,3,H,W) h,s,v in [0,1]
+    return: (N,3,H,W) float in [0,1]
+    """
+    h, s, v = image.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(dtype=torch.int64) % 6
+
+    p = torch.clamp(v * (1.0 - s), 0.0, 1.0)
+    q = torch.clamp(v * (1.0 - s * f), 0.0, 1.0)
+    t = torch.clamp(v * (1.0 - s * (1.0 - f)), 0.0, 1.0)
+
+    # sector i -> (r,g,b)
+    r = torch.stack((v, q, p, p, t, v), dim=1).gather(1, i.unsqueeze(1))
+    g = torch.stack((t, v, v, q, p, p), dim=1).gather(1, i.unsqueeze(1))
+    b = torch.stack((p, p, t, v, v, q), dim=1).gather(1, i.unsqueeze(1))
+
+    return torch.cat((r, g, b), dim=1)
+
+
+class BatchToFloat:
+    def __init__(self, half: Optional[bool] = False) -> None:
+        self.half = half
+
+    def __call__(self, data: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        images, masks = data
+        if not images.is_floating_point():
+            images = images.half() if self.half else images.float()
+            images /= 255.0  # 0-255 to 0.0-1.0
+        return images, masks
+
+
+class BatchRandomHSV:
+    def __init__(
+        self,
+        h_gain: Optional[float] = 0.5,
+        s_gain: Optional[float] = 0.5,
+        v_gain: Optional[float] = 0.5
+    ) -> None:
+        assert h_gain or s_gain or v_gain
+        self.h_gain = h_gain
+        self.s_gain = s_gain
+        self.v_gain = v_gain
+
+    def __call__(self, data: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        images, masks = data
+        assert images.is_floating_point(), 'BatchRandomHSV input must be float in [0,1].'
+
+        bs = images.shape[0]
+        gains = torch.tensor([self.h_gain, self.s_gain, self.v_gain], dtype=torch.float, device=images.device)
+        r = (torch.rand((bs, 3), device=images.device) * 2 - 1) * gains + 1  # random gains per sample
+        r = r[:, :, None, None]  # (N,3,1,1)
+
+        dtype = images.dtype
+        hsv = rgb_to_hsv(images.float())
+        h, s, v = hsv.unbind(1)
+        h = torch.fmod(h * r[:, 0], 1.0)
+        s = torch.clamp(s * r[:, 1], 0, 1)
+        v = torch.clamp(v * r[:, 2], 0, 1)
+
+        images = hsv_to_rgb(torch.stack((h, s, v), dim=1)).to(dtype)
+        return images, masks
+
+
+class BatchRandomFlip:
+    def __init__(
+        self,
+        flip_p: Optional[float] = 0.5,
+        direction: Optional[str] = "horizontal"
+    ) -> None:
+        assert direction in {"horizontal", "vertical"}, f"Support direction `horizontal` or `vertical`, got {direction}"
+        assert 0 <= flip_p <= 1.0
+        self.flip_p = flip_p
+        self.dim = -1 if direction == "horizontal" else -2
+
+    def __call__(self, data: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        images, masks = data
+
+        # image and mask of the same sample share one random draw
+        flip = torch.rand(images.shape[0], device=images.device) < self.flip_p
+        idx = flip.nonzero().squeeze(1)
+        if idx.numel() == 0:
+            return images, masks
+
+        images[idx] = images[idx].flip(self.dim)
+        masks[idx] = masks[idx].flip(self.dim)
+        return images, masks
+
+
+class BatchNormalize:
+    def __init__(
+        self,
+        mean: Optional[List[float]] = None,
+        std: Optional[List[float]] = None
+    ):
+        self.mean = [0.485, 0.456, 0.406] if mean is None else mean
+        self.std = [0.229, 0.224, 0.225] if std is None else std
+
+    def __call__(self, data: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        images, masks = data
+        mean = torch.tensor(self.mean, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+        std = torch.tensor(self.std, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+        images = images.sub(mean).div_(std)
+        return images, masks
+
+
+class BatchToFloatNormalize:
+    # uint8 (N,C,H,W) -> normalized float, fused BatchToFloat + BatchNormalize: (x/255 - mean) / std = x * scale + shift
+    def __init__(
+        self,
+        mean: Optional[List[float]] = None,
+        std: Optional[List[float]] = None,
+        half: Optional[bool] = False
+    ) -> None:
+        mean = [0.485, 0.456, 0.406] if mean is None else mean
+        std = [0.229, 0.224, 0.225] if std is None else std
+        self.dtype = torch.half if half else torch.float
+
+        std = torch.tensor(std, dtype=torch.float)
+        mean = torch.tensor(mean, dtype=torch.float)
+        self.scale = (1.0 / (255.0 * std)).view(1, -1, 1, 1).to(self.dtype)
+        self.shift = (-mean / std).view(1, -1, 1, 1).to(self.dtype)
+
+    def __call__(self, data: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        images, targets = data
+        if images.is_floating_point():  # already normalized in the workers
+            return images, targets
+
+        if self.scale.device != images.device:
+            self.scale = self.scale.to(images.device)
+            self.shift = self.shift.to(images.device)
+
+        images = images.to(self.dtype).mul_(self.scale).add_(self.shift)
+        return images, targets
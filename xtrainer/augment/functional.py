@@ -1,4 +1,6 @@
 from typing import Optional, Tuple
+from functools import lru_cache
+import math
 import random
 import cv2
 import torch
@@ -21,9 +23,9 @@ def random_hsv(
     lut_val = np.clip(x * r[2], 0, 255).astype(dtype)
 
     im_hsv = cv2.merge((cv2.LUT(hue, lut_hue), cv2.LUT(sat, lut_sat), cv2.LUT(val, lut_val)))
-    cv2.cvtColor(im_hsv, cv2.COLOR_HSV2BGR, dst=image)
 
-    return im_hsv
+    # Return a new image, the input may be a cached sample
+    return cv2.cvtColor(im_hsv, cv2.COLOR_HSV2BGR)
 
 
 def random_flip(
@@ -64,17 +66,27 @@ def resize(
     return image
 
 
-def letterbox(
-    image: np.ndarray,
+def letterbox_params(
+    ih: int,
+    iw: int,
     wh: Tuple[int, int],
-    only_scaledown: Optional[bool] = False,
-    pad_value: Tuple[int, int, int] = (114, 114, 114)
-) -> np.ndarray:
-    assert isinstance(image, np.ndarray), 'input image.type must be np.ndarray.'
-
-    ih, iw = image.shape[:2]
-
-    new_w, new_h = wh[0], wh[1]
+    only_scaledown: Optional[bool] = False
+) -> Tuple[int, int, int, int, int, int]:
+    """
+    return: resized (w, h) and padding (top, bottom, left, right)
+    """
+    return _letterbox_params(ih, iw, wh[0], wh[1], bool(only_scaledown))
+
+
+# The geometry only depends on the source (h,w), datasets usually have a handful of sizes
+@lru_cache(maxsize=1024)
+def _letterbox_params(
+    ih: int,
+    iw: int,
+    new_w: int,
+    new_h: int,
+    only_scaledown: bool
+) -> Tuple[int, int, int, int, int, int]:
     # Min scale ratio (new / old)
     r = min(new_h / ih, new_w / iw)
 
@@ -91,14 +103,28 @@ def letterbox(
     dw /= 2
     dh /= 2
 
-    if [ih, iw] != [pad_h, pad_w]:  # resize
-        image = cv2.resize(image, (pad_w, pad_h), interpolation=cv2.INTER_LINEAR)
-
     top = int(round(dh - 0.1))
     bottom = int(round(dh + 0.1))
     left = int(round(dw - 0.1))
     right = int(round(dw + 0.1))
 
+    return pad_w, pad_h, top, bottom, left, right
+
+
+def letterbox(
+    image: np.ndarray,
+    wh: Tuple[int, int],
+    only_scaledown: Optional[bool] = False,
+    pad_value: Tuple[int, int, int] = (114, 114, 114)
+) -> np.ndarray:
+    assert isinstance(image, np.ndarray), 'input image.type must be np.ndarray.'
+
+    ih, iw = image.shape[:2]
+    pad_w, pad_h, top, bottom, left, right = letterbox_params(ih, iw, wh, only_scaledown)
+
+    if [ih, iw] != [pad_h, pad_w]:  # resize
+        image = cv2.resize(image, (pad_w, pad_h), interpolation=cv2.INTER_LINEAR)
+
     image = cv2.copyMakeBorder(
         image,
         top, bottom,
@@ -109,6 +135,106 @@ def letterbox(
     return image
 
 
+def letterbox_into(
+    image: np.ndarray,
+    dst: np.ndarray,
+    only_scaledown: Optional[bool] = False
+) -> None:
+    """
+    Resize image straight into the letterbox area of a preallocated (H,W,C) canvas,
+    the padding area of dst is left untouched.
+    """
+    ih, iw = image.shape[:2]
+    oh, ow = dst.shape[:2]
+    pad_w, pad_h, top, bottom, left, right = letterbox_params(ih, iw, (ow, oh), only_scaledown)
+
+    roi = dst[top:top + pad_h, left:left + pad_w]
+    if [ih, iw] != [pad_h, pad_w]:
+        cv2.resize(image, (pad_w, pad_h), dst=roi, interpolation=cv2.INTER_LINEAR)
+    else:
+        roi[...] = image
+
+
+def random_resized_crop_params(
+    h: int,
+    w: int,
+    scale: Tuple[float, float] = (0.08, 1.0),
+    ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0)
+) -> Tuple[int, int, int, int]:
+    """
+    Same sampling as torchvision RandomResizedCrop.get_params.
+    return: crop (top, left, h, w)
+    """
+    area = h * w
+    log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+
+    for _ in range(10):
+        target_area = area * random.uniform(scale[0], scale[1])
+        aspect_ratio = math.exp(random.uniform(log_ratio[0], log_ratio[1]))
+
+        crop_w = int(round(math.sqrt(target_area * aspect_ratio)))
+        crop_h = int(round(math.sqrt(target_area / aspect_ratio)))
+
+        if 0 < crop_w <= w and 0 < crop_h <= h:
+            i = random.randint(0, h - crop_h)
+            j = random.randint(0, w - crop_w)
+            return i, j, crop_h, crop_w
+
+    # Fallback to central crop
+    in_ratio = w / h
+    if in_ratio < min(ratio):
+        crop_w = w
+        crop_h = int(round(crop_w / min(ratio)))
+    elif in_ratio > max(ratio):
+        crop_h = h
+        crop_w = int(round(crop_h * max(ratio)))
+    else:
+        crop_w = w
+        crop_h = h
+
+    i = (h - crop_h) // 2
+    j = (w - crop_w) // 2
+    return i, j, crop_h, crop_w
+
+
+def letterbox_random_resized_crop(
+    image: np.ndarray,
+    wh: Tuple[int, int],
+    scale: Tuple[float, float] = (0.08, 1.0),
+    ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0),
+    only_scaledown: Optional[bool] = False,
+    pad_value: Tuple[int, int, int] = (114, 114, 114)
+) -> np.ndarray:
+    """
+    letterbox(wh) -> RandomResizedCrop(wh) as one affine warp, the image is resampled once.
+    """
+    assert isinstance(image, np.ndarray), 'input image.type must be np.ndarray.'
+
+    ih, iw = image.shape[:2]
+    out_w, out_h = wh[0], wh[1]
+    pad_w, pad_h, top, bottom, left, right = letterbox_params(ih, iw, wh, only_scaledown)
+
+    # Crop on the letterbox canvas (out_w, out_h)
+    i, j, crop_h, crop_w = random_resized_crop_params(out_h, out_w, scale, ratio)
+
+    # source -> canvas: resize (sx,sy) + pad (left,top), canvas -> output: crop (j,i) + resize (kx,ky)
+    # pixel centers: dst + 0.5 = s * (src + 0.5)
+    sx, sy = pad_w / iw, pad_h / ih
+    kx, ky = out_w / crop_w, out_h / crop_h
+
+    m = np.array([
+        [kx * sx, 0, kx * (0.5 * sx + left - j) - 0.5],
+        [0, ky * sy, ky * (0.5 * sy + top - i) - 0.5]
+    ], dtype=np.float64)
+
+    return cv2.warpAffine(
+        image, m, (out_w, out_h),
+        flags=cv2.INTER_LINEAR,
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=pad_value
+    )
+
+
 def to_tensor(
     data: np.ndarray,
     half: Optional[bool] = False
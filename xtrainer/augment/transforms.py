@@ -13,6 +13,8 @@ from .functional import (
     random_flip,
     resize,
     letterbox,
+    letterbox_into,
+    letterbox_random_resized_crop,
 )
 
 
@@ -122,6 +124,108 @@ class LetterBox:
             return new_image, mask
 
 
+class LetterBoxRandomResizedCrop:
+    # LetterBox + torchvision RandomResizedCrop(hw) merged into one cv2.warpAffine
+    def __init__(
+        self,
+        wh: Tuple[int, int],
+        only_scaledown: Optional[bool] = False,
+        scale: Tuple[float, float] = (0.08, 1.0),
+        ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0)
+    ) -> None:
+        self.wh = wh
+        self.only_scaledown = only_scaledown
+        self.scale = scale
+        self.ratio = ratio
+
+    def __call__(self, image: np.ndarray) -> np.ndarray:
+        assert image is not None, 'image is None.'
+        return letterbox_random_resized_crop(image, self.wh, self.scale, self.ratio, self.only_scaledown)
+
+
+class LetterBoxNormalize:
+    """
+    Fused LetterBox -> ToTensor -> Normalize.
+    The image is resized straight into a preallocated padded uint8 canvas, then converted to a normalized
+    (C,H,W) float tensor in one copy, without the numpy -> PIL -> float -> normalized round trip.
+    reuse=True also reuses the output tensor (single image inference only, the next call overwrites it).
+    """
+
+    def __init__(
+        self,
+        wh: Tuple[int, int],
+        only_scaledown: Optional[bool] = False,
+        mean: Optional[List[float]] = None,
+        std: Optional[List[float]] = None,
+        half: Optional[bool] = False,
+        reuse: Optional[bool] = False,
+        pin_memory: Optional[bool] = False,
+        pad_value: Tuple[int, int, int] = (114, 114, 114)
+    ) -> None:
+        self.wh = wh
+        self.only_scaledown = only_scaledown
+        self.pad_value = pad_value
+        self.dtype = torch.half if half else torch.float
+        self.reuse = reuse
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        mean = [0.485, 0.456, 0.406] if mean is None else mean
+        std = [0.229, 0.224, 0.225] if std is None else std
+
+        # (x/255 - mean) / std = x * scale + shift
+        std = torch.tensor(std, dtype=torch.float)
+        mean = torch.tensor(mean, dtype=torch.float)
+        self.scale = (1.0 / (255.0 * std)).view(-1, 1, 1).to(self.dtype)
+        self.shift = (-mean / std).view(-1, 1, 1).to(self.dtype)
+
+        self._canvas = np.full((wh[1], wh[0], len(pad_value)), pad_value, dtype=np.uint8)
+        self._canvas_hw: Tuple[int, int] = (-1, -1)  # source (h,w) of the current padding
+        self._output: Optional[torch.Tensor] = None
+
+    def _new_output(self) -> torch.Tensor:
+        return torch.empty(
+            (self._canvas.shape[2], self.wh[1], self.wh[0]),
+            dtype=self.dtype,
+            pin_memory=self.pin_memory
+        )
+
+    def _impl(self, image: np.ndarray) -> torch.Tensor:
+        assert image.ndim == 3 and image.shape[2] == self._canvas.shape[2], 'image channels != canvas channels.'
+
+        ih, iw = image.shape[:2]
+        if (ih, iw) != self._canvas_hw:
+            # The letterbox area moves with the source size, reset the padding
+            self._canvas[...] = self.pad_value
+            self._canvas_hw = (ih, iw)
+
+        letterbox_into(image, self._canvas, self.only_scaledown)
+
+        if self.reuse:
+            if self._output is None:
+                self._output = self._new_output()
+            output = self._output
+        else:
+            output = self._new_output()
+
+        # uint8 HWC -> float CHW in one copy, then normalize in place
+        output.copy_(torch.from_numpy(self._canvas).permute(2, 0, 1))
+        output.mul_(self.scale).add_(self.shift)
+        return output
+
+    def __call__(self, data):
+        if isinstance(data, np.ndarray):
+            assert data is not None, 'image is None.'
+            return self._impl(data)
+
+        elif isinstance(data, tuple):
+            image, mask = data
+            assert image is not None, 'image is None.'
+            assert mask is not None, 'mask is None'
+            new_image = self._impl(image)
+            mask = torch.from_numpy(np.ascontiguousarray(hwc2chw(mask)))
+            return new_image, mask
+
+
 class ImgAugT:
     def __init__(self):
         self.t = iaa.Sequential(
@@ -169,6 +273,23 @@ class ToTensor:
         return image, mask
 
 
+class ToUint8Tensor:
+    # (H,W,C) uint8 -> (C,H,W) uint8 view, float conversion happens on the collated batch
+    # Contiguous samples are not copied (fast_collate writes each sample once into the batch),
+    # flipped samples (negative strides, not supported by torch.from_numpy) are copied here
+    @staticmethod
+    def _impl(image: np.ndarray) -> torch.Tensor:
+        return torch.from_numpy(np.ascontiguousarray(image, dtype=np.uint8)).permute(2, 0, 1)
+
+    def __call__(self, data):
+        if isinstance(data, np.ndarray):
+            return self._impl(data)
+
+        elif isinstance(data, tuple):
+            image, mask = data
+            return self._impl(image), self._impl(mask)
+
+
 class Normalize:
     def __init__(
         self,
@@ -0,0 +1,368 @@
+import os
+import time
+import json
+from typing import List, Dict, Any, Callable, Optional, Tuple
+
+import cv2
+import numpy as np
+import torch
+from loguru import logger
+
+from xtrainer import CONFIG, CUDA, VERSION, OS, TORCH_VERSION, TORCHVISION_VERSION, network
+from xtrainer.utils.task import Task
+from xtrainer.utils.labels import Labels
+from xtrainer.utils.common import check_dir, get_time, save_json
+from xtrainer.core.model import Model
+from xtrainer.core.loss import ClassificationLoss, SegmentationLoss
+from xtrainer.core.weights import save_inference_weights
+from xtrainer.core.preprocess import ClsImageT, SegImageT
+from xtrainer.dataset.classification import ClassificationDataset
+from xtrainer.dataset.segmentation import SegmentationDataSet
+from xtrainer.dataset.loader import build_dataloader
+from xtrainer.utils.perf import (
+    topk_accuracy,
+    compute_iou,
+    compute_confusion_matrix_classification,
+    compute_confusion_matrix_segmentation
+)
+
+__all__ = ['Benchmark', 'make_classification_dataset', 'make_segmentation_dataset']
+
+SUITES = ['dataset', 'model', 'loss', 'predict']
+
+
+def _random_image(rng: np.random.Generator, wh: Tuple[int, int]) -> np.ndarray:
+    # Smooth noise, compresses like a real photo (pure noise makes huge jpgs)
+    small = rng.integers(0, 256, (max(wh[1] // 16, 1), max(wh[0] // 16, 1), 3), dtype=np.uint8)
+    return cv2.resize(small, wh, interpolation=cv2.INTER_LINEAR)
+
+
+def make_classification_dataset(root: str, labels: List[str], num_per_class: int, wh: Tuple[int, int]) -> str:
+    # root/<label>/*.jpg
+    rng = np.random.default_rng(0)
+    for label in labels:
+        check_dir(os.path.join(root, label))
+        for i in range(num_per_class):
+            cv2.imwrite(os.path.join(root, label, f'{i:05d}.jpg'), _random_image(rng, wh))
+    return root
+
+
+def make_segmentation_dataset(root: str, labels: List[str], num: int, wh: Tuple[int, int]) -> str:
+    # root/*.jpg + labelme root/*.json (1-3 polygons each, labels[0] is the background), every 4th image is background
+    rng = np.random.default_rng(0)
+    check_dir(root)
+    w, h = wh
+    for i in range(num):
+        name = f'{i:05d}'
+        cv2.imwrite(os.path.join(root, f'{name}.jpg'), _random_image(rng, wh))
+        if i % 4 == 3:
+            continue
+
+        shapes = []
+        for _ in range(int(rng.integers(1, 4))):
+            cx, cy = rng.uniform(0.2, 0.8) * w, rng.uniform(0.2, 0.8) * h
+            r = rng.uniform(0.05, 0.2) * min(w, h)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, int(rng.integers(3, 9))))
+            points = np.stack([cx + r * np.cos(angles), cy + r * np.sin(angles)], axis=1)
+            shapes.append({
+                'label': labels[int(rng.integers(1, len(labels)))],
+                'points': points.round(2).tolist(),
+                'shape_type': 'polygon'
+            })
+
+        save_json({
+            'shapes': shapes,
+            'imagePath': f'{name}.jpg',
+            'imageData': None,
+            'imageHeight': h,
+            'imageWidth': w
+        }, os.path.join(root, f'{name}.json'))
+    return root
+
+
+class Benchmark:
+    """
+    Synthetic throughput benchmark, no real dataset needed:
+        dataset: ClassificationDataset/SegmentationDataSet samples/s, cache x workers (train transforms, fast_collate)
+        model:   forward and forward+backward images/s per network model x wh x batch
+        loss:    loss and metric functions ms/call
+        predict: end to end Predictor images/s (+ cold start) on .xtw weights
+    Results: CONFIG['bench.output'] (json), default <project>/bench.<time>/bench.json
+    """
+
+    def __init__(self):
+        self.task = Task(CONFIG['task'])
+        self.device = torch.device(f'cuda:{CONFIG["device"]}' if CUDA and CONFIG['device'] >= 0 else 'cpu')
+
+        self.root = os.path.join(CONFIG['project'], f'bench.{get_time()}')
+        check_dir(self.root)
+        self.output = CONFIG['bench.output'] or os.path.join(self.root, 'bench.json')
+
+        self.suites: List[str] = CONFIG['bench.suites'] or SUITES
+        self.num_images: int = CONFIG['bench.num_images'] or 64
+        self.image_wh: Tuple[int, int] = tuple(CONFIG['bench.image_wh'] or [640, 480])
+        self.workers: List[int] = CONFIG['bench.workers'] or [0]
+        self.batches: List[int] = CONFIG['bench.batch'] or [8]
+        self.whs: List[Tuple[int, int]] = [tuple(wh) for wh in (CONFIG['bench.wh'] or [CONFIG['wh']])]
+        self.steps: int = CONFIG['bench.steps'] or 20
+
+        self.cls_labels: List[str] = CONFIG['classification.labels'] or ['0', '1']
+        self.seg_labels: List[str] = CONFIG['segmentation.labels'] or ['background', '1']
+
+        self.results: Dict[str, Any] = {
+            'env': {
+                'version': VERSION,
+                'os': OS,
+                'torch': TORCH_VERSION,
+                'torchvision': TORCHVISION_VERSION,
+                'device': str(self.device),
+                'device_name': torch.cuda.get_device_name(self.device) if self.device.type == 'cuda' else 'cpu',
+                'amp': bool(CONFIG['amp']),
+                'time': get_time()
+            }
+        }
+
+    def _sync(self) -> None:
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def _timeit(self, func: Callable, steps: int, warmup: Optional[int] = 3) -> float:
+        # seconds per call
+        for _ in range(warmup):
+            func()
+        self._sync()
+        t0 = time.perf_counter()
+        for _ in range(steps):
+            func()
+        self._sync()
+        return (time.perf_counter() - t0) / steps
+
+    def _autocast(self):
+        dtype = torch.float16 if self.device.type == 'cuda' else torch.bfloat16
+        return torch.autocast(self.device.type, dtype=dtype, enabled=bool(CONFIG['amp']))
+
+    # Dataset ----------------------------------------------------------------------------------------------------------
+    def bench_dataset(self) -> List[dict]:
+        results = []
+        tasks = []
+        if self.task.CLS or self.task.MT:
+            root = make_classification_dataset(
+                os.path.join(self.root, 'classification'),
+                self.cls_labels,
+                max(self.num_images // len(self.cls_labels), 1),
+                self.image_wh
+            )
+            tasks.append(('classification', root))
+        if self.task.SEG or self.task.MT:
+            root = make_segmentation_dataset(
+                os.path.join(self.root, 'segmentation'),
+                self.seg_labels,
+                self.num_images,
+                self.image_wh
+            )
+            tasks.append(('segmentation', root))
+
+        wh = self.whs[0]
+        batch = self.batches[0]
+        for task, root in tasks:
+            for cache in [False, True]:
+                t0 = time.perf_counter()
+                if task == 'classification':
+                    ds = ClassificationDataset(root, wh, Labels(self.cls_labels), transform=ClsImageT(wh), cache=cache)
+                else:
+                    ds = SegmentationDataSet(root, wh, Labels(self.seg_labels), transform=SegImageT(wh), cache=cache)
+                init_time = time.perf_counter() - t0
+
+                for workers in self.workers:
+                    dl = build_dataloader(ds, batch, workers, shuffle=True, pin_memory=self.device.type == 'cuda')
+                    for _ in dl:  # warmup epoch: worker start up
+                        pass
+
+                    t0 = time.perf_counter()
+                    num = 0
+                    for images, _ in dl:
+                        num += images.shape[0]
+                    spend = time.perf_counter() - t0
+
+                    record = {
+                        'task': task,
+                        'cache': cache,
+                        'workers': workers,
+                        'batch': batch,
+                        'wh': list(wh),
+                        'init_s': round(init_time, 4),
+                        'samples_per_s': round(num / spend, 2)
+                    }
+                    logger.info(f'Bench dataset: {record}')
+                    results.append(record)
+        return results
+
+    # Model ------------------------------------------------------------------------------------------------------------
+    def _model_classes(self, name: str) -> Tuple[int, int]:
+        if 'multi_task' in name:
+            return len(self.cls_labels), len(self.seg_labels)
+        if 'segmentation' in name:
+            return 0, len(self.seg_labels)
+        return len(self.cls_labels), 0
+
+    @staticmethod
+    def _output_sum(outputs: Any) -> torch.Tensor:
+        # cls: (N,C), seg: [x1,x2,...], multitask: [[cls],[seg]]
+        if isinstance(outputs, torch.Tensor):
+            return outputs.float().mean()
+        return sum(Benchmark._output_sum(o) for o in outputs)
+
+    def bench_model(self) -> List[dict]:
+        results = []
+        names = CONFIG['bench.models'] or [
+            name for name, obj in network.__dict__.items() if callable(obj) and not name.startswith('_')
+        ]
+
+        for name in names:
+            num_classes, mask_classes = self._model_classes(name)
+            model = Model(
+                name,
+                num_classes,
+                mask_classes,
+                device=self.device.index if self.device.type == 'cuda' else -1
+            )
+            model.init()
+
+            for wh in self.whs:
+                for batch in self.batches:
+                    record = {'model': name, 'wh': list(wh), 'batch': batch}
+                    images = torch.randn((batch, 3, wh[1], wh[0]), device=self.device)
+
+                    def forward():
+                        with torch.no_grad(), self._autocast():
+                            model.net(images)
+
+                    def forward_backward():
+                        with self._autocast():
+                            loss = self._output_sum(model.net(images))
+                        loss.backward()
+
+                    try:
+                        model.eval()
+                        record['forward_images_per_s'] = round(batch / self._timeit(forward, self.steps), 2)
+                        model.train()
+                        record['train_images_per_s'] = round(batch / self._timeit(forward_backward, self.steps), 2)
+                    except (RuntimeError, TypeError, ValueError) as e:  # i.e. oom, inference only models
+                        record['error'] = str(e).split('\n')[0]
+                    finally:
+                        model.net.zero_grad(set_to_none=True)
+
+                    logger.info(f'Bench model: {record}')
+                    results.append(record)
+
+            del model
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+        return results
+
+    # Loss & metric ----------------------------------------------------------------------------------------------------
+    def bench_loss(self) -> List[dict]:
+        results = []
+        wh = self.whs[0]
+        batch = self.batches[0]
+        nc = len(self.cls_labels)
+        mc = len(self.seg_labels)
+
+        cls_pred = torch.randn((batch, nc), device=self.device)
+        cls_target = torch.randint(0, nc, (batch,), device=self.device)
+        seg_outputs = torch.randn((batch, mc, wh[1], wh[0]), device=self.device)
+        seg_target = torch.randint(0, mc, (batch, 1, wh[1], wh[0]), device=self.device)
+
+        alpha = torch.ones((nc,), dtype=torch.float, device=self.device)
+        cls_loss = ClassificationLoss(alpha=alpha, gamma=CONFIG['gamma'] or 2)
+        seg_loss = SegmentationLoss(CONFIG['seg_loss_sum_weights'])
+        topk = [k for k in (CONFIG['topk'] or [1]) if k <= nc] or [1]
+
+        funcs = {
+            'classification_loss': lambda: cls_loss(cls_pred, cls_target),
+            'segmentation_loss': lambda: seg_loss(seg_outputs, seg_target),
+            'topk_accuracy': lambda: topk_accuracy(cls_pred, cls_target, topk),
+            'compute_iou': lambda: compute_iou(seg_outputs, seg_target, mc),
+            'confusion_matrix_classification': lambda: compute_confusion_matrix_classification(
+                cls_pred, cls_target, nc),
+            'confusion_matrix_segmentation': lambda: compute_confusion_matrix_segmentation(
+                seg_outputs, seg_target, mc)
+        }
+
+        for name, func in funcs.items():
+            record = {'name': name, 'wh': list(wh), 'batch': batch}
+            try:
+                record['ms_per_call'] = round(self._timeit(func, self.steps, warmup=1) * 1000, 3)
+            except (RuntimeError, ValueError, IndexError) as e:
+                record['error'] = str(e).split('\n')[0]
+            logger.info(f'Bench loss: {record}')
+            results.append(record)
+        return results
+
+    # Predict ----------------------------------------------------------------------------------------------------------
+    def bench_predict(self) -> List[dict]:
+        from xtrainer.predict import Predictor
+
+        source = os.path.join(self.root, 'predict')
+        check_dir(source)
+        rng = np.random.default_rng(0)
+        for i in range(self.num_images):
+            cv2.imwrite(os.path.join(source, f'{i:05d}.jpg'), _random_image(rng, self.image_wh))
+
+        # Untrained weights of the configured model, exported as .xtw (header gives classes/wh/labels)
+        num_classes, mask_classes = self._model_classes(CONFIG['model'])
+        model = Model(CONFIG['model'], num_classes, mask_classes, device=-1)
+        model.build_model()
+        weight = os.path.join(self.root, 'predict.xtw')
+        save_inference_weights(weight, model.state_dict, {
+            'model_name': CONFIG['model'],
+            'num_classes': num_classes,
+            'mask_classes': mask_classes,
+            'wh': list(self.whs[0]),
+            'cls_labels': self.cls_labels if num_classes else None,
+            'seg_labels': self.seg_labels if mask_classes else None
+        })
+        del model
+
+        # Predictor reads everything from CONFIG
+        CONFIG.update({
+            'source': source,
+            'test_weight': weight,
+            'project': self.root,
+            'cls_thr': [0.0] * len(self.cls_labels),
+            'seg_thr': [0] * (len(self.seg_labels) - 1),
+            'segmentation': dict(CONFIG['segmentation'] or {}, classes=len(self.seg_labels) - 1),
+            'classification': dict(CONFIG['classification'] or {}, classes=len(self.cls_labels))
+        })
+
+        t0 = time.perf_counter()
+        predictor = Predictor()
+        init_time = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        predictor.run()
+        self._sync()
+        spend = time.perf_counter() - t0
+
+        record = {
+            'model': CONFIG['model'],
+            'task': CONFIG['task'],
+            'wh': list(self.whs[0]),
+            'images': self.num_images,
+            'image_wh': list(self.image_wh),
+            'init_s': round(init_time, 4),
+            'images_per_s': round(self.num_images / spend, 2)
+        }
+        logger.info(f'Bench predict: {record}')
+        return [record]
+
+    def run(self) -> None:
+        for suite in self.suites:
+            if suite not in SUITES:
+                raise KeyError(f'bench.suites must be in {SUITES}, but got {suite}')
+            logger.info(f'Bench: {suite}')
+            self.results[suite] = getattr(self, f'bench_{suite}')()
+            save_json(self.results, self.output)  # partial results survive a crash in a later suite
+
+        logger.success(f'Bench results: {self.output}')
+        logger.info(json.dumps(self.results, indent=2, ensure_ascii=False))
@@ -0,0 +1,152 @@
+import os
+import time
+from typing import Callable, List, Tuple, Dict, Any, Optional
+
+import torch
+from loguru import logger
+from torch.utils.data import Dataset
+
+from xtrainer.dataset.loader import build_dataloader, fast_collate
+
+__all__ = ['batch_candidates', 'probe_batch_size', 'probe_loader']
+
+
+def batch_candidates(max_batch: int, min_batch: Optional[int] = 2) -> List[int]:
+    # 2,4,8,...,max_batch
+    candidates = []
+    b = max(min_batch, 1)
+    while b <= max_batch:
+        candidates.append(b)
+        b *= 2
+    return candidates
+
+
+def _is_oom(e: BaseException) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or 'out of memory' in str(e)
+
+
+def probe_batch_size(
+    step_fn: Callable[[int], None],
+    device: torch.device,
+    candidates: List[int],
+    memory_fraction: Optional[float] = 0.85,
+    steps: Optional[int] = 5,
+    min_gain: Optional[float] = 1.05
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    step_fn(batch_size): one forward + loss + backward, without updating the weights.
+    Increasing batch sizes until oom / peak memory > memory_fraction of the device (cuda),
+    or the step throughput stops growing (< min_gain x the previous size).
+    Returns the batch size with the best samples/s.
+    """
+    is_cuda = device.type == 'cuda'
+    total_memory = torch.cuda.get_device_properties(device).total_memory if is_cuda else 0
+
+    records = []
+    best_batch, best_speed = candidates[0], 0.0
+    for batch in candidates:
+        record: Dict[str, Any] = {'batch': batch}
+        try:
+            if is_cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+
+            step_fn(batch)  # warmup: cudnn algorithm search, allocator
+            if is_cuda:
+                torch.cuda.synchronize(device)
+
+            t0 = time.perf_counter()
+            for _ in range(steps):
+                step_fn(batch)
+            if is_cuda:
+                torch.cuda.synchronize(device)
+            speed = batch * steps / (time.perf_counter() - t0)
+
+        except RuntimeError as e:
+            if not _is_oom(e):
+                raise
+            record['oom'] = True
+            records.append(record)
+            logger.info(f'Autotune batch {batch}: out of memory.')
+            break
+
+        record['samples_per_s'] = round(speed, 2)
+        if is_cuda:
+            peak = torch.cuda.max_memory_allocated(device)
+            record['memory'] = round(peak / total_memory, 4)
+        records.append(record)
+        logger.info(f'Autotune batch: {record}')
+
+        if is_cuda and record['memory'] > memory_fraction:
+            # Too close to the limit: augment peaks/fragmentation would oom later in the run
+            break
+
+        if speed > best_speed:
+            improved = speed >= best_speed * min_gain
+            best_batch, best_speed = batch, speed
+            if not improved:
+                break
+        else:
+            break
+
+    if is_cuda:
+        torch.cuda.empty_cache()
+    return best_batch, records
+
+
+def probe_loader(
+    dataset: Dataset,
+    batch_size: int,
+    workers: List[int],
+    prefetch_factors: List[int],
+    steps: Optional[int] = 20,
+    pin_memory: Optional[bool] = True,
+    collate_fn: Optional[Callable] = fast_collate
+) -> Tuple[Tuple[int, Optional[int]], List[Dict[str, Any]]]:
+    """
+    Loader samples/s of every workers x prefetch_factor (the actual dataset transforms, worker start up excluded).
+    Returns the best (workers, prefetch_factor).
+    """
+    steps = max(min(steps, len(dataset) // batch_size - 1), 1)
+    max_workers = os.cpu_count() or 1
+
+    records = []
+    best, best_speed = (0, None), 0.0
+    for num_workers in sorted(set(min(w, max_workers) for w in workers)):
+        for prefetch_factor in (prefetch_factors if num_workers > 0 else [None]):
+            dl = build_dataloader(
+                dataset,
+                batch_size,
+                num_workers,
+                shuffle=True,
+                pin_memory=pin_memory,
+                persistent_workers=False,
+                prefetch_factor=prefetch_factor,
+                collate_fn=collate_fn
+            )
+
+            it = iter(dl)
+            next(it, None)  # worker start up
+            t0 = time.perf_counter()
+            num = 0
+            for _ in range(steps):
+                try:
+                    next(it)
+                except StopIteration:
+                    break
+                num += batch_size
+            speed = num / (time.perf_counter() - t0)
+            del it
+
+            record = {'workers': num_workers, 'prefetch_factor': prefetch_factor, 'samples_per_s': round(speed, 2)}
+            records.append(record)
+            logger.info(f'Autotune loader: {record}')
+
+            if speed > best_speed:
+                best, best_speed = (num_workers, prefetch_factor), speed
+
+    return best, records
+
+
+if __name__ == '__main__':
+    print(batch_candidates(256))  # [2, 4, 8, 16, 32, 64, 128, 256]
@@ -0,0 +1,242 @@
+import os
+import json
+import shutil
+import threading
+from queue import Queue
+from typing import Any, Optional, Dict, Callable
+
+import torch
+from loguru import logger
+
+__all__ = ['snapshot', 'atomic_save', 'AsyncCheckpointWriter', 'CheckpointManager']
+
+
+def snapshot(obj: Any) -> Any:
+    """
+    CPU copy of a (nested) state: every tensor is copied once, containers are rebuilt, other values are kept.
+    Replaces deepcopy(state_dict): no pickling round trip and the copy doubles as the GPU->CPU transfer.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [snapshot(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot(v) for v in obj)
+    return obj
+
+
+def _fsync_dir(path: str) -> None:
+    if os.name == 'nt':  # directories can not be opened on windows
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_save(state: dict, path: str) -> None:
+    # tmp file + fsync + rename: a crash never leaves a truncated checkpoint behind
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+class AsyncCheckpointWriter:
+    """
+    Training only blocks for the in-memory snapshot, serialization and fsync run on a background thread.
+    Jobs (save/remove/...) run one by one in submit order.
+    """
+    _STOP = object()
+
+    def __init__(self) -> None:
+        self._queue: Queue = Queue()
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _check_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Async checkpoint writing failed.') from error
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                func, args = item
+                func(*args)
+            except BaseException as e:  # reported on the next submit/wait
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def submit(self, func: Callable, *args) -> None:
+        self._check_error()
+        self._queue.put((func, args))
+
+    @staticmethod
+    def _save(state: dict, path: str) -> None:
+        atomic_save(state, path)
+        logger.info(f'Save checkpoint: {path}')
+
+    def save(self, state: dict, path: str) -> None:
+        # state: a snapshot() (CPU copy), it is written later and must not change meanwhile
+        self.submit(self._save, state, path)
+
+    def copy(self, src: str, dst: str) -> None:
+        # src is complete once the jobs submitted before have run
+        self.submit(_link_or_copy, src, dst)
+
+    def remove(self, path: str) -> None:
+        self.submit(_remove, path)
+
+    def wait(self) -> None:
+        self._queue.join()
+        self._check_error()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+        self._check_error()
+
+
+def _remove(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    # atomic_save replaces src with a new file, a hard link keeps the old content
+    tmp_path = f'{dst}.tmp'
+    _remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:  # no hard links on this filesystem
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+    _fsync_dir(os.path.dirname(os.path.abspath(dst)))
+    logger.info(f'Save checkpoint: {dst}')
+
+
+def _atomic_save_json(data: dict, path: str) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager:
+    """
+    weights/
+        epoch{N}.pth        every save_period epochs, only the last keep_last are kept (0: keep all)
+        last.pth            every epoch
+        best.pth            best val score (higher is better)
+        checkpoints.json    checkpoint -> epoch/score/metrics, plus best/last, reloaded when the manager is created
+    The state is serialized once per epoch (last.pth), epoch{N}.pth and best.pth are hard links (or copies) of it.
+    Files and index are written by the AsyncCheckpointWriter in order, the index never points to a missing file.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        save_period: Optional[int] = 1,
+        keep_last: Optional[int] = 0,
+        writer: Optional[AsyncCheckpointWriter] = None,
+        best_score: Optional[float] = None
+    ) -> None:
+        self.root = root
+        self.save_period = max(save_period or 1, 1)
+        self.keep_last = keep_last or 0
+        self.writer = AsyncCheckpointWriter() if writer is None else writer
+
+        self.best_score: Optional[float] = best_score  # i.e. from the resumed checkpoint
+        self.index: Dict[str, Any] = {
+            'best': None,
+            'last': None,
+            'checkpoints': {}  # file -> record
+        }
+        self._load_index()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, 'checkpoints.json')
+
+    def _load_index(self) -> None:
+        # Resume into the same weights dir: keep best_score and the epoch files to retain
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Can not read {self.index_path} ({e}), start a new index.')
+            return
+
+        self.index.update(index)
+        best = self.index.get('best')
+        if self.best_score is None and best is not None:
+            self.best_score = best.get('score')
+        logger.info(f'Checkpoint index: {len(self.index["checkpoints"])} checkpoints, best score {self.best_score}.')
+
+    def update(
+        self,
+        state: dict,
+        epoch: int,
+        metrics: Optional[Dict[str, float]] = None,
+        score: Optional[float] = None
+    ) -> None:
+        # The previous epoch is on disk by now (normally), at most two snapshots are held in memory
+        self.writer.wait()
+
+        record = {
+            'epoch': epoch,
+            'score': score,
+            'metrics': dict(metrics or {})
+        }
+
+        is_best = score is not None and (self.best_score is None or score > self.best_score)
+        if is_best:
+            self.best_score = score
+        state['best_score'] = self.best_score  # restored by resume, the state is a private snapshot
+
+        last_path = os.path.join(self.root, 'last.pth')
+        self.writer.save(state, last_path)
+        self.index['last'] = dict(record, file='last.pth')
+
+        if epoch % self.save_period == 0:
+            name = f'epoch{epoch}.pth'
+            self.writer.copy(last_path, os.path.join(self.root, name))
+            self.index['checkpoints'][name] = record
+            self._retain()
+
+        if is_best:
+            self.writer.copy(last_path, os.path.join(self.root, 'best.pth'))
+            self.index['best'] = dict(record, file='best.pth')
+            logger.info(f'Best checkpoint: epoch {epoch}, score {score:.4f}.')
+
+        # copy: the writer serializes it later
+        self.writer.submit(_atomic_save_json, json.loads(json.dumps(self.index)), self.index_path)
+
+    def _retain(self) -> None:
+        if self.keep_last <= 0:
+            return
+
+        names = list(self.index['checkpoints'].keys())  # insertion order == epoch order
+        for name in names[:-self.keep_last]:
+            self.index['checkpoints'].pop(name)
+            self.writer.remove(os.path.join(self.root, name))
+
+    def close(self) -> None:
+        self.writer.close()
@@ -0,0 +1,85 @@
+import math
+from copy import deepcopy
+from typing import Optional, Dict, List
+
+import torch
+from torch import nn
+
+__all__ = ['ModelEMA']
+
+
+class ModelEMA:
+    """
+    Exponential moving average of the model weights (parameters + float buffers i.e. BN running stats).
+        ema = d * ema + (1 - d) * model, d = decay * (1 - exp(-updates / tau))
+    tau: decay warmup, the early (random) weights are forgotten quickly.
+    interval: update every N optimizer steps.
+    The tensor lists are collected once, every update is two _foreach kernels without a per-parameter python loop.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        decay: Optional[float] = 0.9999,
+        tau: Optional[float] = 2000,
+        interval: Optional[int] = 1,
+        updates: Optional[int] = 0
+    ) -> None:
+        self.module = deepcopy(model).eval()  # model: the bare net, without the DDP wrapper
+        self.module.requires_grad_(False)
+
+        self.decay = decay
+        self.tau = tau
+        self.interval = max(interval or 1, 1)
+        self.updates = updates  # ema updates
+        self._steps = 0  # optimizer steps
+
+        self._ema_float: List[torch.Tensor] = []
+        self._model_float: List[torch.Tensor] = []
+        self._ema_other: List[torch.Tensor] = []
+        self._model_other: List[torch.Tensor] = []
+        self._bind(model)
+
+    def _bind(self, model: nn.Module) -> None:
+        # state_dict tensors share storage with the live parameters/buffers, updated in place by the optimizer
+        ema_state = self.module.state_dict()
+        for key, value in model.state_dict().items():
+            if value.is_floating_point():
+                self._ema_float.append(ema_state[key])
+                self._model_float.append(value)
+            else:  # i.e. num_batches_tracked
+                self._ema_other.append(ema_state[key])
+                self._model_other.append(value)
+
+    def get_decay(self) -> float:
+        if not self.tau:
+            return self.decay
+        return self.decay * (1 - math.exp(-self.updates / self.tau))
+
+    @torch.no_grad()
+    def update(self) -> None:
+        self._steps += 1
+        if self._steps % self.interval != 0:
+            return
+
+        self.updates += 1
+        d = self.get_decay()
+
+        torch._foreach_mul_(self._ema_float, d)
+        torch._foreach_add_(self._ema_float, self._model_float, alpha=1 - d)
+        for ema_value, value in zip(self._ema_other, self._model_other):
+            ema_value.copy_(value)
+
+    def __call__(self, images: torch.Tensor):
+        with torch.no_grad():
+            return self.module(images)
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return self.module.state_dict()
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict: Dict[str, torch.Tensor], updates: Optional[int] = None) -> None:
+        # copy_ in place, the cached tensor lists stay valid
+        self.module.load_state_dict(state_dict)
+        if updates is not None:
+            self.updates = updates
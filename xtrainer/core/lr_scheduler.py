@@ -1,42 +1,148 @@
-from typing import Optional
+from typing import Optional, List
 import math
 from torch import optim
-from torch.optim.lr_scheduler import LambdaLR
+
+__all__ = ['LRSchedulerWrapper', 'SCHEDULERS', 'WARMUP_METHODS']
+
+SCHEDULERS = ['linear', 'cos', 'poly', 'cos_restarts', 'onecycle']
+WARMUP_METHODS = ['linear', 'exp']
 
 
 class LRSchedulerWrapper:
+    """
+    Step granular lr schedule: lr = initial_lr * table[step], the table (warmup + decay) is computed once,
+    every update() is one list lookup per param group.
+    One update() per optimizer step (not per batch), so accumulation steps do not advance the schedule.
+        linear:       1 -> lrf
+        cos:          1 -> lrf, cosine
+        poly:         1 -> lrf, (1 - p) ** power
+        cos_restarts: cosine 1 -> lrf, restarted `cycles` times
+        onecycle:     1/div -> 1 (cosine, warmup steps or 30%) -> lrf (cosine), the warmup is built in
+    warmup(linear/exp): warmup_factor -> 1 over warmup_epochs, then the decay starts.
+    """
+
     def __init__(
         self,
         optimizer: optim.Optimizer,
-        last_epoch: Optional[int] = -1,
+        last_step: Optional[int] = -1,
         lrf: Optional[float] = 0.01,
         epochs: Optional[int] = 100,
         cos_lr: Optional[bool] = False,
+        steps_per_epoch: Optional[int] = 1,
+        scheduler: Optional[str] = None,
+        warmup_epochs: Optional[float] = 0,
+        warmup_method: Optional[str] = 'linear',
+        warmup_factor: Optional[float] = 0.001,
+        power: Optional[float] = 0.9,
+        cycles: Optional[int] = 1,
+        div_factor: Optional[float] = 25.0
     ):
-        if cos_lr:
-            lr_lambda = self._cos_lr_lambda(1, lrf, epochs)
-        else:
-            lr_lambda = self._linear_lr_lambda(epochs, lrf)
-
-        self.scheduler = LambdaLR(optimizer, lr_lambda=lr_lambda, last_epoch=last_epoch)
-
-    @staticmethod
-    def _easy_lr_lambda():
-        return lambda x: 1 / (x / 4 + 1)
+        if scheduler is None:
+            scheduler = 'cos' if cos_lr else 'linear'
+        if scheduler not in SCHEDULERS:
+            raise ValueError(f'lr_scheduler must be in {SCHEDULERS}, but got {scheduler}')
+        if warmup_method not in WARMUP_METHODS:
+            raise ValueError(f'warmup_method must be in {WARMUP_METHODS}, but got {warmup_method}')
+
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.steps_per_epoch = max(int(steps_per_epoch), 1)
+        self.total_steps = max(int(epochs), 1) * self.steps_per_epoch
+        self.warmup_steps = min(int(round((warmup_epochs or 0) * self.steps_per_epoch)), self.total_steps)
+
+        for group in optimizer.param_groups:
+            group.setdefault('initial_lr', group['lr'])
+        self.base_lrs: List[float] = [group['initial_lr'] for group in optimizer.param_groups]
+
+        self.table: List[float] = self._build_table(
+            lrf, warmup_method, warmup_factor, power, max(int(cycles or 1), 1), div_factor
+        )
+
+        self.last_step = last_step
+        self.update()
+
+    def _build_table(
+        self,
+        lrf: float,
+        warmup_method: str,
+        warmup_factor: float,
+        power: float,
+        cycles: int,
+        div_factor: float
+    ) -> List[float]:
+        total = self.total_steps
+        warmup = self.warmup_steps
+
+        if self.scheduler == 'onecycle':
+            # The rising half is the warmup
+            rise = warmup if warmup > 0 else int(total * 0.3)
+            start = 1.0 / div_factor
+            table = [
+                self._cos(start, 1.0, x / rise) if x < rise else self._cos(1.0, lrf, (x - rise) / max(total - rise, 1))
+                for x in range(total + 1)
+            ]
+            return table
+
+        decay = total - warmup
+        table = []
+        for x in range(total + 1):
+            if x < warmup:
+                table.append(self._warmup(warmup_method, warmup_factor, x / warmup))
+            else:
+                table.append(self._decay(lrf, (x - warmup) / max(decay, 1), power, cycles))
+        return table
 
     @staticmethod
-    def _cos_lr_lambda(y1: float = 0.0, y2: float = 1.0, steps: int = 100):
-        return lambda x: max((1 - math.cos(x * math.pi / steps)) / 2, 0) * (y2 - y1) + y1
+    def _cos(y1: float, y2: float, p: float) -> float:
+        return y2 + (y1 - y2) * (1 + math.cos(math.pi * min(p, 1.0))) / 2
 
     @staticmethod
-    def _linear_lr_lambda(epochs: int, lrf: float):
-        return lambda x: max(1 - x / epochs, 0) * (1.0 - lrf) + lrf  # linear
-
-    def func(self):
-        return self.scheduler
-
-    def update(self, epoch: Optional[int] = None):
-        self.scheduler.step(epoch)
+    def _warmup(method: str, factor: float, p: float) -> float:
+        if method == 'exp':
+            return factor ** (1 - p)
+        return factor + (1 - factor) * p
+
+    def _decay(self, lrf: float, p: float, power: float, cycles: int) -> float:
+        p = min(p, 1.0)
+        if self.scheduler == 'cos':
+            return self._cos(1.0, lrf, p)
+        if self.scheduler == 'poly':
+            return (1 - p) ** power * (1.0 - lrf) + lrf
+        if self.scheduler == 'cos_restarts':
+            # The last step stays at lrf instead of restarting
+            return self._cos(1.0, lrf, 1.0 if p >= 1.0 else (p * cycles) % 1.0)
+        return (1 - p) * (1.0 - lrf) + lrf  # linear
+
+    def get_lrs(self) -> List[float]:
+        factor = self.table[min(max(self.last_step, 0), self.total_steps)]
+        return [lr * factor for lr in self.base_lrs]
+
+    def update(self) -> None:
+        # After every optimizer step
+        self.last_step += 1
+        for group, lr in zip(self.optimizer.param_groups, self.get_lrs()):
+            group['lr'] = lr
+
+    def state_dict(self) -> dict:
+        return {
+            'last_step': self.last_step,
+            'steps_per_epoch': self.steps_per_epoch,
+            'base_lrs': self.base_lrs
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        if 'last_step' in state_dict:
+            last_step = state_dict['last_step']
+            # Another batch size: keep the position in epochs
+            saved_steps_per_epoch = state_dict.get('steps_per_epoch', self.steps_per_epoch)
+            if saved_steps_per_epoch != self.steps_per_epoch:
+                last_step = round(last_step / saved_steps_per_epoch * self.steps_per_epoch)
+        else:  # per epoch LambdaLR checkpoints
+            last_step = state_dict['last_epoch'] * self.steps_per_epoch
+
+        self.base_lrs = list(state_dict.get('base_lrs', self.base_lrs))
+        self.last_step = last_step - 1
+        self.update()
 
 
 if __name__ == '__main__':
@@ -56,11 +162,12 @@ if __name__ == '__main__':
 
     net = Net()
 
-    optimizer = torch.optim.SGD([{'params': net.parameters(), 'initial_lr': 1}], lr=1)
-    scheduler = LRSchedulerWrapper(optimizer)
-
-    for i in range(9):
-        print("lr of epoch", i, "=>", scheduler.func().get_last_lr())
-        print("lr of epoch", i, "=>", optimizer.param_groups[0]['lr'])
-        optimizer.step()
-        scheduler()
+    for name in SCHEDULERS:
+        optimizer = torch.optim.SGD([{'params': net.parameters(), 'initial_lr': 1}], lr=1)
+        scheduler = LRSchedulerWrapper(optimizer, epochs=3, steps_per_epoch=4, scheduler=name, warmup_epochs=1)
+        lrs = []
+        for i in range(12):
+            lrs.append(round(optimizer.param_groups[0]['lr'], 4))
+            optimizer.step()
+            scheduler.update()
+        print(name, '=>', lrs)
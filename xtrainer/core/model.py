@@ -4,9 +4,11 @@ from typing import Optional, Any, Dict
 import torch
 import torchvision
 from loguru import logger
+from torch.nn.parallel import DistributedDataParallel
 
 from xtrainer import network
 from xtrainer.utils.common import error_exit
+from xtrainer.core.weights import is_inference_weights, load_inference_weights, torch_load
 
 __all__ = ['Model']
 
@@ -22,6 +24,8 @@ class Model:
         device: Optional[int] = 0,  # -1==cpu
         strict: Optional[bool] = False,
         map_location: Optional[str] = 'cpu',
+        memory_format: Optional[torch.memory_format] = torch.contiguous_format,
+        prefix_map: Optional[Dict[str, str]] = None
     ):
         self._is_gpu = False
         self._model_name = model_name
@@ -33,6 +37,9 @@ class Model:
         self._strict = strict
         self._device = torch.device('cpu')
         self._map_location = map_location
+        self._memory_format = memory_format
+        # weight key prefix -> model key prefix
+        self._prefix_map: Dict[str, str] = {'module.': '', '_orig_mod.': ''} if prefix_map is None else prefix_map
 
         self.set_device(device)
 
@@ -46,9 +53,16 @@ class Model:
     def model_name(self) -> str:
         return self._model_name
 
+    @property
+    def net(self) -> torch.nn.Module:
+        # The bare network, without the DDP wrapper
+        if isinstance(self._net, DistributedDataParallel):
+            return self._net.module
+        return self._net
+
     @property
     def state_dict(self) -> dict:
-        return self._net.state_dict()
+        return self.net.state_dict()  # no 'module.' prefix
 
     @property
     def device(self) -> torch.device:
@@ -63,6 +77,10 @@ class Model:
             self._is_gpu = True
         logger.info(f'Setting model to {self._device}')
 
+    @property
+    def memory_format(self) -> torch.memory_format:
+        return self._memory_format
+
     @property
     def is_gpu(self) -> bool:
         return self._is_gpu
@@ -91,7 +109,9 @@ class Model:
         self._net.eval()
 
     def to_device(self) -> None:
-        self._net.to(self._device)
+        self._net.to(self._device, memory_format=self._memory_format)
+        if self._memory_format == torch.channels_last:
+            logger.info('Model memory format: channels_last.')
 
     def set_weight(self, path: str) -> None:
         self._weight = path
@@ -99,10 +119,20 @@ class Model:
     def set_net(self, val) -> None:
         self._net = val
 
+    def wrap_ddp(self, sync_bn: Optional[bool] = False) -> None:
+        # Call after init(), every rank starts from the rank 0 weights (DDP broadcasts them)
+        if sync_bn and self._is_gpu:
+            self._net = torch.nn.SyncBatchNorm.convert_sync_batchnorm(self._net).to(self._device)
+            logger.info('Model: SyncBatchNorm.')
+
+        device_ids = [self._device.index] if self._is_gpu else None
+        self._net = DistributedDataParallel(self._net, device_ids=device_ids)
+        logger.info(f'Model: DistributedDataParallel({self._device}).')
+
     def init(self) -> None:
         self.build_model()
-        self.load_weight()
         self.to_device()
+        self.load_weight()  # weights are copied straight into the device parameters
 
     def build_model(self) -> None:
         net = network.__dict__.get(self.model_name, None)
@@ -133,33 +163,84 @@ class Model:
         self._net = net(**net_args)
         logger.info('Build Model Done.')
 
+    def _read_state_dict(self, path: str) -> Optional[Dict[str, torch.Tensor]]:
+        if is_inference_weights(path):
+            # .xtw: zero copy mmap, checkpoint holds the header metadata (model_name/classes/wh/labels)
+            state_dict, self._checkpoint = load_inference_weights(path)
+            return state_dict
+
+        if path.endswith('.safetensors'):
+            try:
+                from safetensors.torch import load_file
+            except ImportError:
+                logger.error('Loading .safetensors needs the safetensors package.')
+                return None
+            self._checkpoint = {}
+            return load_file(path, device='cpu')  # zero copy mmap
+
+        self._checkpoint = torch_load(path, self._map_location)
+        if 'state_dict' in self._checkpoint:
+            return self._checkpoint['state_dict']
+
+        # bare state_dict file
+        if all(isinstance(v, torch.Tensor) for v in self._checkpoint.values()):
+            return self._checkpoint
+
+        return None
+
+    def _remap_keys(self, state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        # i.e. {'module.': ''} strips the DistributedDataParallel prefix
+        if not self._prefix_map:
+            return state_dict
+
+        remapped = {}
+        for key, value in state_dict.items():
+            for src, dst in self._prefix_map.items():
+                if key.startswith(src):
+                    key = dst + key[len(src):]
+                    break
+            remapped[key] = value
+        return remapped
+
     def load_weight(self) -> None:
 
         if (self._weight is None) or (os.path.exists(self._weight) is False):
             logger.warning('Weight is not found.')
             return
 
-        self._checkpoint = torch.load(self._weight, map_location=self._map_location)
-        weight_state_dict = self.checkpoint.get('state_dict', None)
+        weight_state_dict = self._read_state_dict(self._weight)
 
         if weight_state_dict is None:
             logger.error('Weight.state_dict is not found.')
             return
 
-        model_state_dict = self._net.state_dict()
-
-        total_item = 0
-        loading_item = 0
-
-        for (net_key, net_value), (weight_key, weight_value) in zip(model_state_dict.items(),
-                                                                    weight_state_dict.items()):
-            total_item += 1
-
-            if net_value.shape == weight_value.shape:
-                model_state_dict[net_key] = weight_value
-                loading_item += 1
-
-        self._net.load_state_dict(model_state_dict, strict=self._strict)
+        weight_state_dict = self._remap_keys(weight_state_dict)
+        model_state_dict = self.net.state_dict()
+
+        # Match by name, never by position
+        matched = {}
+        unexpected = []
+        shape_mismatch = []
+        for key, value in weight_state_dict.items():
+            if key not in model_state_dict:
+                unexpected.append(key)
+            elif model_state_dict[key].shape != value.shape:
+                shape_mismatch.append(f'{key}: {tuple(value.shape)} != {tuple(model_state_dict[key].shape)}')
+            else:
+                matched[key] = value
+        missing = [key for key in model_state_dict.keys() if key not in matched]
+
+        if self._strict and (unexpected or shape_mismatch or missing):
+            raise RuntimeError(
+                f'Weight does not match the model: unexpected={unexpected}, '
+                f'shape_mismatch={shape_mismatch}, missing={missing}'
+            )
+
+        # copy_ into the parameters, already on the target device
+        self.net.load_state_dict(matched, strict=False)
 
         logger.info(f'Loading :{self._weight}.')
-        logger.info(f'Loading [{loading_item}/{total_item}] item to model.')
+        logger.info(f'Loading [{len(matched)}/{len(model_state_dict)}] item to model.')
+        for name, keys in (('Missing', missing), ('Unexpected', unexpected), ('Shape mismatch', shape_mismatch)):
+            if keys:
+                logger.warning(f'{name} [{len(keys)}]: {keys[:5]}{" ..." if len(keys) > 5 else ""}')
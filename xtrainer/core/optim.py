@@ -1,17 +1,54 @@
-from contextlib import contextmanager
-from typing import Dict, Optional, List, Union
+import inspect
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional, List, Union, Iterator
 
 import torch
+from torch import nn
 from torch.optim import Optimizer
-from torch.cuda.amp import GradScaler
+from torch.amp import GradScaler
+from loguru import logger
 
 __all__ = [
     'OptimWrapper',
     'AMPOptimWrapper',
+    'build_param_groups',
+    'build_optimizer',
     'build_optimizer_wrapper',
-    'build_amp_optimizer_wrapper'
+    'build_amp_optimizer_wrapper',
+    'get_amp_dtype',
+    'OPTIMIZER_IMPLS'
 ]
 
+OPTIMIZER_IMPLS = ['auto', 'fused', 'foreach', 'for_loop']
+
+_NORM_LAYERS = (
+    nn.modules.batchnorm._BatchNorm,  # BatchNorm1d/2d/3d, SyncBatchNorm
+    nn.modules.instancenorm._InstanceNorm,  # noqa
+    nn.GroupNorm,
+    nn.LayerNorm,
+    nn.LocalResponseNorm
+)
+
+AMP_DTYPES = {
+    'float16': torch.float16,
+    'fp16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'bf16': torch.bfloat16,
+}
+
+
+def get_amp_dtype(device_type: str, name: Optional[str] = 'auto') -> torch.dtype:
+    """
+    auto: cuda->float16, cpu->bfloat16 (cpu autocast only supports bfloat16 well)
+    """
+    if name is None or name == 'auto':
+        return torch.float16 if device_type == 'cuda' else torch.bfloat16
+
+    dtype = AMP_DTYPES.get(name.lower())
+    if dtype is None:
+        raise ValueError(f'amp_dtype must be in {["auto"] + list(AMP_DTYPES.keys())}, but got {name}')
+    return dtype
+
 
 class OptimWrapper:
     def __init__(self, optimizer: Optimizer):
@@ -19,6 +56,17 @@ class OptimWrapper:
                                                   f'{type(optimizer)}')
         self.optimizer = optimizer
         self._update_count = 0
+        self._ema = None  # ModelEMA, updated after every optimizer step
+        self._profiler = None  # StepProfiler, times backward/optimizer
+
+    def set_ema(self, ema) -> None:
+        self._ema = ema
+
+    def set_profiler(self, profiler) -> None:
+        self._profiler = profiler
+
+    def _stage(self, name: str):
+        return nullcontext() if self._profiler is None else self._profiler.stage(name)
 
     def zero_grad(self, **kwargs) -> None:
         self.optimizer.zero_grad(**kwargs)
@@ -50,36 +98,50 @@ class OptimWrapper:
         step_kwargs = step_kwargs or {}
         zero_kwargs = zero_kwargs or {}
 
-        loss.backward(**loss_kwargs)
-        self.optimizer.step(**step_kwargs)
-        self.zero_grad(**zero_kwargs)
-        self._update_count += 1
+        with self._stage('backward'):
+            loss.backward(**loss_kwargs)
+        with self._stage('optimizer'):
+            self.optimizer.step(**step_kwargs)
+            self.zero_grad(**zero_kwargs)
+            self._update_count += 1
+            if self._ema is not None:
+                self._ema.update()
+
+    def autocast(self):
+        # Forward scope: full precision
+        return nullcontext()
 
     @contextmanager
     def context(self):
-        try:
-            yield self
-        finally:
-            self.zero_grad()
+        # Update scope: backward + step, never run under autocast
+        yield self
 
 
 class AMPOptimWrapper(OptimWrapper):
     def __init__(
         self,
         loss_scale: Union[str, float, Dict] = 'dynamic',
+        device_type: Optional[str] = 'cuda',
+        dtype: Optional[torch.dtype] = None,
         **kwargs
     ):
         super().__init__(**kwargs)
+        self.device_type = device_type
+        self.dtype = get_amp_dtype(device_type) if dtype is None else dtype
+
+        # bfloat16 has the same exponent range as float32, loss scaling is only needed for float16
+        use_scaler = self.dtype == torch.float16
+
         self._scale_update_param = None
         if loss_scale == 'dynamic':
-            self.grad_scaler = GradScaler()
+            self.grad_scaler = GradScaler(device_type, enabled=use_scaler)
 
         elif isinstance(loss_scale, float):
             self._scale_update_param = loss_scale
-            self.grad_scaler = GradScaler(init_scale=loss_scale)
+            self.grad_scaler = GradScaler(device_type, init_scale=loss_scale, enabled=use_scaler)
 
         elif isinstance(loss_scale, dict):
-            self.grad_scaler = GradScaler(**loss_scale)
+            self.grad_scaler = GradScaler(device_type, enabled=use_scaler, **loss_scale)
 
         else:
             raise TypeError(f'loss_scale must be of type float, dict, or dynamic", but got {loss_scale}')
@@ -106,23 +168,128 @@ class AMPOptimWrapper(OptimWrapper):
         step_kwargs = step_kwargs or {}
         zero_kwargs = zero_kwargs or {}
 
-        self.grad_scaler.scale(loss).backward(**loss_kwargs)
-        self.grad_scaler.step(self.optimizer, **step_kwargs)
-        self.grad_scaler.update()
-        self.zero_grad(**zero_kwargs)
+        with self._stage('backward'):
+            self.grad_scaler.scale(loss).backward(**loss_kwargs)
+        with self._stage('optimizer'):
+            self.grad_scaler.step(self.optimizer, **step_kwargs)
+            self.grad_scaler.update()
+            self.zero_grad(**zero_kwargs)
+            self._update_count += 1
+            if self._ema is not None:
+                self._ema.update()
 
-    @contextmanager
-    def context(self):
-        from torch.cuda.amp import autocast
-        with autocast():
-            yield self
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype)
+
+
+def _lr_mult(name: str, lr_mults: Dict[str, float]) -> float:
+    # The longest matching prefix wins, i.e. {'backbone': 0.1, 'backbone.layer4': 0.5}
+    # Whole module names only: 'backbone' does not match 'backbone2.*'
+    prefixes = [
+        prefix for prefix in lr_mults
+        if name == prefix.rstrip('.') or name.startswith(prefix.rstrip('.') + '.')
+    ]
+    if not prefixes:
+        return 1.0
+    return float(lr_mults[max(prefixes, key=len)])
+
+
+def build_param_groups(
+    model: nn.Module,
+    lr: float,
+    weight_decay: Optional[float] = 0.0,
+    lr_mults: Optional[Dict[str, float]] = None
+) -> List[dict]:
+    """
+    One group per (decay, lr_mult):
+        no decay: biases and norm layer (BN/GN/LN...) weights, every 1-D parameter
+        lr_mult:  parameter name prefix -> lr multiplier, i.e. backbone vs heads
+    'initial_lr' is set per group, the lr scheduler scales every group from its own initial lr.
+    """
+    lr_mults = lr_mults or {}
+    groups: Dict[tuple, dict] = {}
+
+    for module_name, module in model.named_modules():
+        for param_name, param in module.named_parameters(recurse=False):
+            if not param.requires_grad:
+                continue
+
+            name = f'{module_name}.{param_name}' if module_name else param_name
+            no_decay = isinstance(module, _NORM_LAYERS) or param.ndim <= 1
+            mult = _lr_mult(name, lr_mults)
+
+            key = (no_decay, mult)
+            if key not in groups:
+                groups[key] = {
+                    'params': [],
+                    'lr': lr * mult,
+                    'initial_lr': lr * mult,
+                    'weight_decay': 0.0 if no_decay else weight_decay,
+                    'lr_mult': mult
+                }
+            groups[key]['params'].append(param)
 
+    return list(groups.values())
 
-def build_optimizer(name: str, **kwargs) -> Optimizer:
+
+def _params_of(params: Union[Iterator, List]) -> List[torch.Tensor]:
+    tensors = []
+    for p in params:
+        if isinstance(p, dict):
+            tensors.extend(p['params'])
+        else:
+            tensors.append(p)
+    return tensors
+
+
+def _impl_candidates(optim: type, params: List[torch.Tensor], impl: str) -> List[dict]:
+    # fused: one kernel for the whole step, foreach: one kernel per op over all tensors, for_loop: per tensor
+    args = inspect.signature(optim.__init__).parameters
+    has_fused = 'fused' in args
+    has_foreach = 'foreach' in args
+
+    if impl == 'for_loop':
+        return [{'foreach': False}] if has_foreach else [{}]
+    if impl == 'foreach':
+        return [{'foreach': True}, {}] if has_foreach else [{}]
+    if impl == 'fused':
+        return [{'fused': True}, {}] if has_fused else [{}]
+
+    candidates = []
+    # cuda (and recent cpu) kernels, unsupported combinations raise and fall through to foreach
+    if has_fused and params and all(p.is_cuda and p.is_floating_point() for p in params):
+        candidates.append({'fused': True})
+    if has_foreach:
+        candidates.append({'foreach': True})
+    candidates.append({})
+    return candidates
+
+
+def build_optimizer(name: str, impl: Optional[str] = 'auto', **kwargs) -> Optimizer:
     optim = torch.optim.__dict__.get(name)
     assert optim is not None
-    optimizer = optim(**kwargs)
-    return optimizer
+
+    if impl not in OPTIMIZER_IMPLS:
+        raise ValueError(f'optimizer_impl must be in {OPTIMIZER_IMPLS}, but got {impl}')
+
+    # generators can only be consumed once
+    params = kwargs['params']
+    params = [dict(p, params=list(p['params'])) if isinstance(p, dict) else p for p in params]
+    kwargs['params'] = params
+
+    candidates = _impl_candidates(optim, _params_of(params), impl)
+    for i, impl_kwargs in enumerate(candidates):
+        try:
+            optimizer = optim(**kwargs, **impl_kwargs)
+        except (RuntimeError, ValueError, TypeError) as e:
+            if i == len(candidates) - 1:
+                raise
+            logger.warning(f'{name}({impl_kwargs}) is not supported: {e}')
+            continue
+
+        impl_name = 'fused' if impl_kwargs.get('fused') else 'foreach' if impl_kwargs.get('foreach') else 'default'
+        logger.info(f'Optimizer implementation: {impl_name}.')
+        return optimizer
 
 
 def build_optimizer_wrapper(name: str, **kwargs) -> OptimWrapper:
@@ -131,7 +298,53 @@ def build_optimizer_wrapper(name: str, **kwargs) -> OptimWrapper:
     return optimizer_wrapper
 
 
-def build_amp_optimizer_wrapper(name: str, **kwargs) -> AMPOptimWrapper:
+def build_amp_optimizer_wrapper(
+    name: str,
+    device_type: Optional[str] = 'cuda',
+    dtype: Optional[torch.dtype] = None,
+    **kwargs
+) -> AMPOptimWrapper:
     optimizer = build_optimizer(name, **kwargs)
-    amp_optimizer_wrapper = AMPOptimWrapper(optimizer=optimizer)
+    amp_optimizer_wrapper = AMPOptimWrapper(optimizer=optimizer, device_type=device_type, dtype=dtype)
     return amp_optimizer_wrapper
+
+
+if __name__ == '__main__':
+    # Micro benchmark: optimizer step time per optimizer/implementation/param groups
+    import time
+    from torchvision.models import resnet18
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    steps = 50
+
+    net = resnet18(num_classes=10).to(device)
+    for p in net.parameters():
+        p.grad = torch.randn_like(p)
+
+    for optim_name in ['SGD', 'AdamW']:
+        for impl in ['for_loop', 'foreach', 'fused']:
+            for grouped in [False, True]:
+                if grouped:
+                    params = build_param_groups(net, 0.001, 0.0005, {'fc': 10})
+                else:
+                    params = [{'params': list(net.parameters()), 'initial_lr': 0.001}]
+
+                try:
+                    opt = build_optimizer(optim_name, impl=impl, params=params, lr=0.001)
+                except (RuntimeError, ValueError, TypeError) as e:
+                    print(f'{optim_name:<6} {impl:<8} groups={grouped!s:<5} => not supported ({e})')
+                    continue
+
+                for _ in range(5):  # warmup, lazy state init
+                    opt.step()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+
+                t0 = time.perf_counter()
+                for _ in range(steps):
+                    opt.step()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                ms = (time.perf_counter() - t0) / steps * 1000
+
+                print(f'{optim_name:<6} {impl:<8} groups={grouped!s:<5} => {ms:.3f} ms/step')
@@ -9,9 +9,19 @@ from xtrainer.augment.transforms import (
     RandomHSV,
     NP2PIL,
     LetterBox,
+    LetterBoxNormalize,
+    LetterBoxRandomResizedCrop,
     ToTensor,
+    ToUint8Tensor,
     Normalize
 )
+from xtrainer.augment.batch import (
+    BatchToFloat,
+    BatchRandomHSV,
+    BatchRandomFlip,
+    BatchNormalize,
+    BatchToFloatNormalize
+)
 
 
 # Base Transform -------------------------------------------------------------------------------------------------------
@@ -20,6 +30,7 @@ class BaseT:
     def __init__(self) -> None:
         self.mean = [0.485, 0.456, 0.406]
         self.std = [0.229, 0.224, 0.225]
+        self.mean_uint8 = [round(m * 255) for m in self.mean]
         self.ops = []
         self.default_ops = [
             T.ToTensor(),
@@ -36,21 +47,24 @@ class BaseT:
 
 # Classification Transform ---------------------------------------------------------------------------------------------
 class ClsImageT(BaseT):
-    def __init__(self, wh: Tuple[int, int], only_scaledown: bool = False):
+    def __init__(self, wh: Tuple[int, int], only_scaledown: bool = False, uint8: bool = False):
         super().__init__()
         assert wh is not None, 'imgsz is not None.'
-        hw = (wh[1], wh[0])
         self.ops = [
-            LetterBox(wh, only_scaledown),
+            LetterBoxRandomResizedCrop(wh, only_scaledown),
             NP2PIL(),
-            T.RandomResizedCrop(hw),
             T.RandomHorizontalFlip(),
             T.RandomVerticalFlip(),
             # T.RandAugment(interpolation=T.InterpolationMode.BILINEAR),
             T.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.7, hue=0.015)
         ]
-        self.ops += self.default_ops
-        self.ops += [T.RandomErasing(inplace=True)]
+        if uint8:
+            # uint8 (C,H,W) leaves the workers, BatchNormT normalizes on the device.
+            # Erase with the mean color, which is 0 after normalization (same as value=0 on the float path)
+            self.ops += [T.PILToTensor(), T.RandomErasing(value=self.mean_uint8, inplace=True)]
+        else:
+            self.ops += self.default_ops
+            self.ops += [T.RandomErasing(inplace=True)]
 
         self.t = self.compose()
 
@@ -69,14 +83,13 @@ class ClsTargetT(BaseT):
 
 
 class ClsValT(BaseT):
-    def __init__(self, wh: Tuple[int, int], only_scaledown: bool = False) -> None:
+    def __init__(self, wh: Tuple[int, int], only_scaledown: bool = False, uint8: bool = False) -> None:
         super().__init__()
         assert wh is not None, 'image wh is None.'
-        self.ops = [
-            LetterBox(wh, only_scaledown),
-            NP2PIL()
-        ]
-        self.ops += self.default_ops
+        if uint8:
+            self.ops = [LetterBox(wh, only_scaledown), ToUint8Tensor()]
+        else:
+            self.ops = [LetterBoxNormalize(wh, only_scaledown, self.mean, self.std)]
         self.t = self.compose()
 
     def __call__(self, image) -> torch.Tensor:
@@ -90,7 +103,8 @@ class SegImageT(BaseT):
         self,
         wh: Tuple[int, int],
         half: Optional[bool] = False,
-        only_scaledown: bool = False
+        only_scaledown: bool = False,
+        uint8: bool = False
     ) -> None:
         super().__init__()
         assert wh is not None, 'imgsz is not None.'
@@ -98,10 +112,12 @@ class SegImageT(BaseT):
             LetterBox(wh, only_scaledown),
             RandomHSV(),
             RandomFlip(direction="vertical"),
-            RandomFlip(direction="horizontal"),
-            ToTensor(half),
-            Normalize()
+            RandomFlip(direction="horizontal")
         ]
+        if uint8:
+            self.ops += [ToUint8Tensor()]  # BatchNormT normalizes on the device
+        else:
+            self.ops += [ToTensor(half), Normalize()]
         self.t = self.compose()
 
     def __call__(self, data: Tuple[np.ndarray, np.ndarray]) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -109,21 +125,73 @@ class SegImageT(BaseT):
         return image, mask
 
 
-class SegValT(BaseT):
+class SegBatchImageT(BaseT):
+    # Worker side of the batch augment backend: only letterbox, the batch leaves the workers as uint8
     def __init__(
         self,
         wh: Tuple[int, int],
-        only_scaledown: Optional[bool] = False
+        only_scaledown: bool = False
     ) -> None:
         super().__init__()
         assert wh is not None, 'imgsz is not None.'
         self.ops = [
             LetterBox(wh, only_scaledown),
-            ToTensor(),
-            Normalize()
+            ToUint8Tensor()
+        ]
+        self.t = self.compose()
+
+    def __call__(self, data: Tuple[np.ndarray, np.ndarray]) -> Tuple[torch.Tensor, torch.Tensor]:
+        image, mask = self.t(data)
+        return image, mask
+
+
+class SegBatchT(BaseT):
+    # Device side of the batch augment backend: same augment as SegImageT on the collated batch (N,C,H,W)
+    def __init__(self, half: Optional[bool] = False) -> None:
+        super().__init__()
+        self.ops = [
+            BatchToFloat(half),
+            BatchRandomHSV(),
+            BatchRandomFlip(direction="vertical"),
+            BatchRandomFlip(direction="horizontal"),
+            BatchNormalize(self.mean, self.std)
+        ]
+        self.t = self.compose()
+
+    def __call__(self, data: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        images, masks = self.t(data)
+        return images, masks
+
+
+class BatchNormT(BaseT):
+    # Device side of the uint8 transport: uint8 (N,C,H,W) batch -> normalized float, targets pass through
+    def __init__(self, half: Optional[bool] = False) -> None:
+        super().__init__()
+        self.ops = [
+            BatchToFloatNormalize(self.mean, self.std, half)
         ]
         self.t = self.compose()
 
+    def __call__(self, data: Tuple[torch.Tensor, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        images, targets = self.t(data)
+        return images, targets
+
+
+class SegValT(BaseT):
+    def __init__(
+        self,
+        wh: Tuple[int, int],
+        only_scaledown: Optional[bool] = False,
+        uint8: bool = False
+    ) -> None:
+        super().__init__()
+        assert wh is not None, 'imgsz is not None.'
+        if uint8:
+            self.ops = [LetterBox(wh, only_scaledown), ToUint8Tensor()]
+        else:
+            self.ops = [LetterBoxNormalize(wh, only_scaledown, self.mean, self.std)]
+        self.t = self.compose()
+
     def __call__(self, data: Tuple[np.ndarray, np.ndarray]) -> Tuple[torch.Tensor, torch.Tensor]:
         image, mask = self.t(data)
         return image, mask
@@ -133,15 +201,15 @@ class InferT(BaseT):
     def __init__(
         self,
         wh: Tuple[int, int],
-        only_scaledown: bool = False
+        only_scaledown: bool = False,
+        half: bool = False
     ) -> None:
         super().__init__()
         assert wh is not None, 'image wh is None.'
+        # One image at a time: reuse the canvas and the (pinned) output tensor
         self.ops = [
-            LetterBox(wh, only_scaledown),
-            NP2PIL()
+            LetterBoxNormalize(wh, only_scaledown, self.mean, self.std, half=half, reuse=True, pin_memory=True)
         ]
-        self.ops += self.default_ops
         self.t = self.compose()
 
     def __call__(self, image) -> torch.Tensor:
@@ -0,0 +1,165 @@
+import os
+import json
+import mmap
+import struct
+from typing import Dict, Any, Tuple, Optional, List
+
+import torch
+from loguru import logger
+
+# Flat inference weights (.xtw), only tensors + a small json header, memory mapped on load:
+#   [u64 little endian header size][json header][padding][tensor data, every tensor 64 bytes aligned]
+#   header = {'metadata': {model_name, num_classes, mask_classes, wh, cls_labels, seg_labels},
+#             'tensors': {name: {'dtype': 'float32', 'shape': [...], 'offset': [begin, end]}}}
+# offsets are relative to the start of the data section.
+
+__all__ = [
+    'WEIGHTS_EXT',
+    'is_inference_weights',
+    'save_inference_weights',
+    'read_inference_header',
+    'load_inference_weights',
+    'torch_load',
+    'export_inference_weights'
+]
+
+WEIGHTS_EXT = '.xtw'
+_ALIGN = 64
+
+_DTYPES: Dict[str, torch.dtype] = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'float64': torch.float64,
+    'int64': torch.int64,
+    'int32': torch.int32,
+    'int16': torch.int16,
+    'int8': torch.int8,
+    'uint8': torch.uint8,
+    'bool': torch.bool
+}
+_DTYPE_NAMES: Dict[torch.dtype, str] = {v: k for k, v in _DTYPES.items()}
+
+
+def _align(n: int) -> int:
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def is_inference_weights(path: str) -> bool:
+    return path.endswith(WEIGHTS_EXT)
+
+
+def save_inference_weights(path: str, state_dict: Dict[str, torch.Tensor], metadata: Dict[str, Any]) -> None:
+    tensors = {}
+    offset = 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in _DTYPE_NAMES:
+            raise TypeError(f'Unsupported dtype {tensor.dtype}: {name}')
+        nbytes = tensor.numel() * tensor.element_size()
+        tensors[name] = {
+            'dtype': _DTYPE_NAMES[tensor.dtype],
+            'shape': list(tensor.shape),
+            'offset': [offset, offset + nbytes]
+        }
+        offset = _align(offset + nbytes)
+
+    header = json.dumps({'metadata': metadata, 'tensors': tensors}, ensure_ascii=False).encode('utf-8')
+    data_begin = _align(8 + len(header))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_begin - 8 - len(header)))
+
+        for name, tensor in state_dict.items():
+            begin, end = tensors[name]['offset']
+            f.seek(data_begin + begin)
+            if end > begin:
+                # raw bytes in native (little endian) order
+                data = tensor.detach().cpu().contiguous().view(-1).view(torch.uint8)
+                f.write(data.numpy().tobytes())
+        f.truncate(data_begin + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_header(f) -> Tuple[Dict[str, Any], int]:
+    (header_size,) = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(header_size).decode('utf-8'))
+    return header, _align(8 + header_size)
+
+
+def read_inference_header(path: str) -> Dict[str, Any]:
+    # Only the metadata, without touching the tensor data
+    with open(path, 'rb') as f:
+        header, _ = _read_header(f)
+    return header['metadata']
+
+
+def load_inference_weights(path: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    """
+    Zero copy: every tensor is a view into the memory mapped file (copy on write), pages are read on first touch.
+    """
+    with open(path, 'rb') as f:
+        header, data_begin = _read_header(f)
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)  # writable for torch.frombuffer, never written back
+
+    state_dict: Dict[str, torch.Tensor] = {}
+    for name, info in header['tensors'].items():
+        dtype = _DTYPES[info['dtype']]
+        shape: List[int] = info['shape']
+        begin, end = info['offset']
+
+        if end == begin:
+            state_dict[name] = torch.empty(shape, dtype=dtype)
+            continue
+
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=data_begin + begin)
+        state_dict[name] = tensor.view(shape)
+
+    return state_dict, header['metadata']
+
+
+def torch_load(path: str, map_location: Any = 'cpu') -> Dict[str, Any]:
+    # mmap: tensors are paged in while copied into the parameters, no full read up front
+    try:
+        return torch.load(path, map_location=map_location, mmap=True, weights_only=True)
+    except Exception as e:  # training checkpoints also pickle rng states (numpy)
+        logger.debug(f'weights_only load failed ({e}), fall back to full unpickling.')
+
+    try:
+        return torch.load(path, map_location=map_location, mmap=True, weights_only=False)
+    except RuntimeError:  # legacy (non zip) files can not be memory mapped
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def export_inference_weights(
+    checkpoint_path: str,
+    save_path: Optional[str] = None,
+    wh: Optional[List[int]] = None,
+    cls_labels: Optional[List[str]] = None,
+    seg_labels: Optional[List[str]] = None
+) -> str:
+    # training checkpoint (.pth) -> inference weights (.xtw), optimizer and rng states are dropped
+    checkpoint = torch_load(checkpoint_path)
+    state_dict = checkpoint.get('state_dict', checkpoint)
+
+    # Older checkpoints do not store the class counts: the heads are built from the labels
+    metadata = {
+        'model_name': checkpoint.get('model_name'),
+        'num_classes': checkpoint.get('num_classes') or len(cls_labels or []),
+        'mask_classes': checkpoint.get('mask_classes') or len(seg_labels or []),
+        'epoch': checkpoint.get('epoch'),
+        'wh': list(wh) if wh is not None else None,
+        'cls_labels': cls_labels,
+        'seg_labels': seg_labels
+    }
+
+    if save_path is None:
+        save_path = os.path.splitext(checkpoint_path)[0] + WEIGHTS_EXT
+
+    save_inference_weights(save_path, state_dict, metadata)
+    return save_path
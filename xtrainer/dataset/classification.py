@@ -1,6 +1,6 @@
 import os
+import math
 import random
-from collections import defaultdict
 from typing import Optional, Callable, Tuple, List
 
 import numpy as np
@@ -16,62 +16,89 @@ from xtrainer.utils.common import get_images
 from xtrainer.augment.functional import letterbox
 
 
-# old
 class BalancedBatchSampler(Sampler):
+    """
+    Every batch holds batch_size//nc samples of each class.
+    Batches are rebuilt every epoch (call set_epoch), so all samples are visited over the epochs.
+    oversample=False: the epoch length follows the rarest class.
+    oversample=True: the epoch length follows the largest class, minority classes are repeated.
+    num_replicas/rank: each rank gets a disjoint slice of the batches (distributed training).
+    """
+
     def __init__(
         self,
         labels: list,
-        batch_size: int
+        batch_size: int,
+        oversample: Optional[bool] = False,
+        seed: Optional[int] = 0,
+        num_replicas: Optional[int] = 1,
+        rank: Optional[int] = 0
     ) -> None:
         super().__init__(None)
-        self.labels = labels
+        assert 0 <= rank < num_replicas, f'rank must be in [0,{num_replicas})'
+
         self.batch_size = batch_size
-        self.label_to_indices = defaultdict(list)
+        self.oversample = oversample
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
 
-        '''{
-        0:[idx1,idx2,...],
-        1:[],
-        2:[],
-        ...
-        }'''
+        labels = np.asarray(labels, dtype=np.int64)
+        classes, counts = np.unique(labels, return_counts=True)
+        order = np.argsort(labels, kind='stable')
 
-        for idx, label in enumerate(labels):
-            self.label_to_indices[label].append(idx)
+        # [idx(class0)...,idx(class1)...,...] -> [[idx(class0)...],[idx(class1)...],...]
+        self.label_to_indices: List[np.ndarray] = np.split(order, np.cumsum(counts)[:-1])
 
-        self.nc = len(self.label_to_indices)  # nc!= model.classes
+        self.nc = len(classes)  # nc!= model.classes
         self.image_per_nc = self.batch_size // self.nc  # images per num of classes
+        assert self.image_per_nc > 0, f'batch_size({batch_size}) < num of classes({self.nc})'
+
+        # num_batches=最少(或最多)数据的类别可以分几份
+        if self.oversample:
+            self.num_batches = math.ceil(counts.max() / self.image_per_nc)
+        else:
+            self.num_batches = int(counts.min()) // self.image_per_nc
+
+        # Every rank runs the same number of steps
+        self.num_batches_per_rank = self.num_batches // self.num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
 
-        self.batches = self._create_batches()
+    def _class_samples(self, rng: np.random.Generator, indices: np.ndarray) -> np.ndarray:
+        need = self.num_batches * self.image_per_nc
+        if need <= len(indices):
+            return rng.permutation(indices)[:need]
 
-    def _create_batches(self) -> list:
-        # Shuffle the indices within each label
-        for label in self.label_to_indices:
-            np.random.shuffle(self.label_to_indices[label])
+        # Oversample: repeat whole permutations, so each sample is drawn before any repeats
+        repeats = math.ceil(need / len(indices))
+        tiled = rng.permuted(np.tile(indices, (repeats, 1)), axis=1)
+        return tiled.reshape(-1)[:need]
 
-        min_samples = min(len(indices) for indices in self.label_to_indices.values())
+    def _create_batches(self) -> np.ndarray:
+        # Same seed+epoch on every rank -> same batches, then each rank takes its own slice
+        rng = np.random.default_rng((self.seed, self.epoch))
 
-        # num_batches=最少数据的类别最小可以分几份
-        num_batches = min_samples // self.image_per_nc
+        # (num_batches, nc*image_per_nc)
+        batches = np.concatenate([
+            self._class_samples(rng, indices).reshape(self.num_batches, self.image_per_nc)
+            for indices in self.label_to_indices
+        ], axis=1)
 
-        # bss=[bs,bs,bs,...]
-        batches = []
-        for _ in range(num_batches):
-            batch = []
-            for label in self.label_to_indices:
-                batch.extend(self.label_to_indices[label][:self.image_per_nc])
-                self.label_to_indices[label] = self.label_to_indices[label][self.image_per_nc:]
-            np.random.shuffle(batch)
-            batches.append(batch)
+        batches = rng.permuted(batches, axis=1)  # shuffle inside the batch
+        batches = batches[rng.permutation(self.num_batches)]  # shuffle the batches
 
-        return batches
+        batches = batches[:self.num_batches_per_rank * self.num_replicas]
+        return batches[self.rank::self.num_replicas]
 
     def __iter__(self):
-        np.random.shuffle(self.batches)
-        for batch in self.batches:
+        for batch in self._create_batches().tolist():
             yield batch
 
     def __len__(self) -> int:
-        return len(self.batches)
+        return self.num_batches_per_rank
 
 
 class ClassificationDataset(BaseDataset):
@@ -122,7 +149,7 @@ class ClassificationDataset(BaseDataset):
             self.targets *= rate
 
     def load_data(self) -> None:
-        for idx in tqdm(range(self._labels.size), desc='Loading data'):
+        for idx in tqdm(range(self._labels.nc), desc='Loading data'):
 
             target_path: str = os.path.join(self._root, self._labels[idx])
             images: List[str] = get_images(target_path, self._SUPPORT_IMG_FORMAT)
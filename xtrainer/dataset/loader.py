@@ -0,0 +1,223 @@
+import time
+import threading
+from queue import Queue, Empty, Full
+from typing import Optional, Callable, List, Any, Sequence, Union, Iterator
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler, get_worker_info
+from torch.utils.data._utils.collate import default_collate
+
+__all__ = ['fast_collate', 'build_dataloader', 'DataPrefetcher']
+
+
+def _to_chw(item: Any) -> torch.Tensor:
+    # (H,W,C) ndarray -> (C,H,W) view, (H,W) -> (1,H,W), tensors are already (C,H,W)
+    if isinstance(item, np.ndarray):
+        item = torch.from_numpy(item)
+        return item.unsqueeze(0) if item.dim() == 2 else item.permute(2, 0, 1)
+    return item
+
+
+def _stack_uint8(items: Sequence[Any]) -> torch.Tensor:
+    items = [_to_chw(item) for item in items]
+    out = torch.empty((len(items), *items[0].shape), dtype=torch.uint8)
+    if get_worker_info() is not None:
+        # The batch is sent to the main process through shared memory
+        out.share_memory_()
+    # One copy per sample, the layout change is done by the same copy
+    return torch.stack(items, out=out)
+
+
+def _is_uint8(item: Any) -> bool:
+    return isinstance(item, (np.ndarray, torch.Tensor)) and item.dtype in (np.uint8, torch.uint8)
+
+
+def fast_collate(batch: List[tuple]) -> tuple:
+    """
+    uint8 images/masks ((H,W,C) ndarray or (C,H,W) tensor) are stacked into one (N,C,H,W) uint8 tensor,
+    float conversion and normalization are left to the device.
+    Everything else goes through default_collate.
+    """
+    fields = list(zip(*batch))
+    return tuple(
+        _stack_uint8(field) if _is_uint8(field[0]) else default_collate(list(field))
+        for field in fields
+    )
+
+
+def build_dataloader(
+    dataset: Dataset,
+    batch_size: int,
+    workers: int,
+    shuffle: Optional[bool] = False,
+    drop_last: Optional[bool] = False,
+    sampler: Optional[Sampler] = None,
+    batch_sampler: Optional[Sampler] = None,
+    pin_memory: Optional[bool] = True,
+    persistent_workers: Optional[bool] = True,
+    prefetch_factor: Optional[int] = None,
+    collate_fn: Optional[Callable] = fast_collate
+) -> DataLoader:
+    kwargs = {
+        'dataset': dataset,
+        'num_workers': workers,
+        'pin_memory': pin_memory,
+        'collate_fn': collate_fn
+    }
+
+    if batch_sampler is not None:
+        # batch_size,shuffle,sampler,drop_last are mutually exclusive with batch_sampler
+        kwargs['batch_sampler'] = batch_sampler
+    else:
+        kwargs.update({
+            'batch_size': batch_size,
+            'shuffle': shuffle if sampler is None else False,
+            'sampler': sampler,
+            'drop_last': drop_last
+        })
+
+    # Only valid with worker processes
+    if workers > 0:
+        kwargs['persistent_workers'] = bool(persistent_workers)
+        if prefetch_factor:
+            kwargs['prefetch_factor'] = prefetch_factor
+
+    return DataLoader(**kwargs)
+
+
+class DataPrefetcher:
+    """
+    Wraps a DataLoader, the next batches are fetched in a background thread while the current step computes.
+    cuda: the H2D copy (non_blocking, from pinned memory) runs in a side stream, the consumer only waits on its event.
+    cpu: the thread overlaps the dataloader fetch (and workers=0 loading) with compute.
+    """
+    _END = object()
+
+    def __init__(
+        self,
+        loader: DataLoader,
+        device: Union[str, torch.device],
+        memory_format: Optional[torch.memory_format] = torch.contiguous_format,
+        depth: Optional[int] = 2
+    ) -> None:
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+        self.depth = depth
+        self.is_cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.is_cuda else None
+
+        # Step time breakdown of the last epoch (seconds)
+        self.fetch_time = 0.0  # producer: dataloader next + copy launch
+        self.wait_time = 0.0  # consumer: blocked waiting for a batch
+        self.total_time = 0.0
+        self.num_batches = 0
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def _to_device(self, data: Any) -> Any:
+        if isinstance(data, torch.Tensor):
+            if self.is_cuda:
+                data = data.to(self.device, non_blocking=True)
+            # Only images (N,C,H,W) follow the model memory format
+            if data.dim() == 4 and data.is_floating_point():
+                data = data.contiguous(memory_format=self.memory_format)
+            return data
+        if isinstance(data, (tuple, list)):
+            return type(data)(self._to_device(d) for d in data)
+        return data
+
+    def _record_stream(self, data: Any, stream: torch.cuda.Stream) -> None:
+        # Tensors were allocated on the side stream, keep the allocator from reusing them too early
+        if isinstance(data, torch.Tensor) and data.is_cuda:
+            data.record_stream(stream)
+        elif isinstance(data, (tuple, list)):
+            for d in data:
+                self._record_stream(d, stream)
+
+    @staticmethod
+    def _put(queue: Queue, stop: threading.Event, item: Any) -> None:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def _producer(self, queue: Queue, stop: threading.Event) -> None:
+        try:
+            it = iter(self.loader)
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                try:
+                    data = next(it)
+                except StopIteration:
+                    break
+
+                event = None
+                if self.is_cuda:
+                    with torch.cuda.stream(self.stream):
+                        data = self._to_device(data)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    data = self._to_device(data)
+                self.fetch_time += time.perf_counter() - t0
+
+                self._put(queue, stop, (data, event))
+            self._put(queue, stop, self._END)
+        except BaseException as e:  # re-raised in the consumer
+            self._put(queue, stop, e)
+
+    def __iter__(self) -> Iterator[Any]:
+        self.fetch_time = 0.0
+        self.wait_time = 0.0
+        self.num_batches = 0
+        start = time.perf_counter()
+
+        queue: Queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._producer, args=(queue, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                t0 = time.perf_counter()
+                item = queue.get()
+                self.wait_time += time.perf_counter() - t0
+
+                if item is self._END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+
+                data, event = item
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    self._record_stream(data, stream)
+
+                self.num_batches += 1
+                yield data
+        finally:
+            stop.set()
+            # Unblock a producer waiting on a full queue
+            try:
+                while True:
+                    queue.get_nowait()
+            except Empty:
+                pass
+            thread.join()
+            self.total_time = time.perf_counter() - start
+
+    def summary(self) -> str:
+        overlap = max(self.fetch_time - self.wait_time, 0.0)
+        ratio = overlap / self.fetch_time * 100 if self.fetch_time > 0 else 0.0
+        compute = self.total_time - self.wait_time
+        return (
+            f'Data time: {self.num_batches} batches, epoch {self.total_time:.2f}s, '
+            f'compute {compute:.2f}s, fetch {self.fetch_time:.2f}s, wait {self.wait_time:.2f}s, '
+            f'overlapped {overlap:.2f}s ({ratio:.1f}%)'
+        )
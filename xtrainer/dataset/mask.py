@@ -0,0 +1,86 @@
+import os
+import hashlib
+from dataclasses import dataclass
+from typing import Optional, Tuple, List
+
+import numpy as np
+
+__all__ = ['RLEMask', 'rle_encode', 'rle_decode', 'MaskCache']
+
+
+@dataclass
+class RLEMask:
+    # Run-length encoded uint8 mask, values[i] repeats counts[i] times in C order
+    shape: Tuple[int, ...]
+    values: np.ndarray  # uint8
+    counts: np.ndarray  # uint32
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.counts.nbytes
+
+    def decode(self) -> np.ndarray:
+        return rle_decode(self)
+
+
+def rle_encode(mask: np.ndarray) -> RLEMask:
+    flat = np.ascontiguousarray(mask, dtype=np.uint8).ravel()
+    if flat.size == 0:
+        return RLEMask(mask.shape, np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.uint32))
+
+    # run starts: index 0 and every position where the value changes
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    counts = np.diff(np.append(starts, flat.size)).astype(np.uint32)
+    return RLEMask(mask.shape, flat[starts], counts)
+
+
+def rle_decode(rle: RLEMask) -> np.ndarray:
+    if rle.values.size == 1:
+        return np.full(rle.shape, rle.values[0], dtype=np.uint8)
+    return np.repeat(rle.values, rle.counts).reshape(rle.shape)
+
+
+class MaskCache:
+    """
+    Lazily rasterized segmentation masks stored as uint8 .npy files.
+    The files are shared by all dataloader workers (and later runs) through the disk and the OS page cache.
+    An entry is keyed by label path + json mtime + image wh + model wh + the ordered label list,
+    editing the json or the labels (the pixel values are the label indices) invalidates it.
+    """
+
+    def __init__(self, root: str, wh: Tuple[int, int], labels: Optional[List[str]] = None) -> None:
+        self._root = root
+        self._wh = wh
+        self._labels_key = hashlib.md5('\n'.join(labels or []).encode('utf-8')).hexdigest()
+        os.makedirs(self._root, exist_ok=True)
+
+    @property
+    def root(self) -> str:
+        return self._root
+
+    def _file(self, label_path: str, mtime: int, image_wh: Tuple[int, int]) -> str:
+        key = '|'.join([
+            os.path.abspath(label_path),
+            str(mtime),
+            f'{image_wh[0]}x{image_wh[1]}',
+            f'{self._wh[0]}x{self._wh[1]}',
+            self._labels_key
+        ])
+        name = hashlib.md5(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._root, f'{name}.npy')
+
+    def get(self, label_path: str, mtime: int, image_wh: Tuple[int, int]) -> Optional[np.ndarray]:
+        path = self._file(label_path, mtime, image_wh)
+        try:
+            return np.load(path)
+        except (FileNotFoundError, ValueError, EOFError, OSError):
+            return None
+
+    def put(self, label_path: str, mtime: int, image_wh: Tuple[int, int], mask: np.ndarray) -> None:
+        path = self._file(label_path, mtime, image_wh)
+
+        # Workers may write the same entry at the same time: write to a private file then rename atomically
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.ascontiguousarray(mask, dtype=np.uint8))
+        os.replace(tmp, path)
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Callable, List, Tuple
 import cv2
 import numpy as np
@@ -8,10 +9,11 @@ from tqdm import tqdm
 
 from xtrainer.dataset import Image
 from xtrainer.dataset.base import BaseDataset
+from xtrainer.dataset.mask import MaskCache, RLEMask, rle_encode
 from xtrainer.augment.functional import letterbox
-from xtrainer.utils.labels import MaskLabel, Labels
+from xtrainer.utils.labels import MaskLabel, Labels, Shape
 from xtrainer.utils.common import (
-    load_json,
+    load_labelme_json,
     get_images,
     get_image_wh,
     hw_to_hw1,
@@ -29,7 +31,8 @@ class SegmentationDataSet(BaseDataset):
         img_type: Optional[str] = 'RGB',
         transform: Optional[Callable] = None,  # to samples
         expanding_rate: Optional[int] = 1,
-        cache: Optional[bool] = False
+        cache: Optional[bool] = False,
+        mask_cache_dir: Optional[str] = None
     ) -> None:
         super(SegmentationDataSet, self).__init__(
             root=root,
@@ -42,6 +45,12 @@ class SegmentationDataSet(BaseDataset):
 
         self._labels = labels
 
+        # Lazily rasterized masks, only needed when the samples are not cached in memory
+        self._mask_cache: Optional[MaskCache] = None
+        if mask_cache_dir and not self._use_cache:
+            self._mask_cache = MaskCache(mask_cache_dir, wh, labels.labels)
+            logger.info(f'Mask cache: {mask_cache_dir}')
+
         self.samples_with_label: List[Tuple[Image, MaskLabel]] = []
         self.background_samples: List[Tuple[Image, MaskLabel]] = []
 
@@ -67,18 +76,34 @@ class SegmentationDataSet(BaseDataset):
         name, ext = os.path.splitext(basename)
         return path.replace(ext, '.json')
 
-    def load_data(self) -> None:
-        for image_path in tqdm(self.all_image_path, desc='Loading data'):
-
-            label = MaskLabel()  # Empty label
-            image = Image(path=image_path)  # Just only have image path
+    @staticmethod
+    def _read_label(label_path: str) -> Optional[MaskLabel]:
+        if os.path.exists(label_path) is False:
+            return None
 
-            label_path: str = self.find_label_path(image_path)
-            if os.path.exists(label_path) is True:
+        # load and decode json data
+        label = MaskLabel()
+        label.path = label_path
+        label.mtime = os.stat(label_path).st_mtime_ns
+        label.set_metadata(load_labelme_json(label_path))
+        return label
 
-                # load and decode json data
-                label.set_metadata(load_json(label_path))
+    def load_data(self) -> None:
+        label_paths = [self.find_label_path(image_path) for image_path in self.all_image_path]
+
+        # json reading is mostly io, parse the files in a thread pool
+        num_workers = min(32, (os.cpu_count() or 1) + 4)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            labels = list(tqdm(
+                executor.map(self._read_label, label_paths),
+                total=len(label_paths),
+                desc='Loading data'
+            ))
+
+        for image_path, label in zip(self.all_image_path, labels):
+            image = Image(path=image_path)  # Just only have image path
 
+            if label is not None:
                 # check image path
                 if os.path.basename(image_path) != label.image_path:
                     logger.warning(f'img_path != json.imagePath,{image_path}')
@@ -87,12 +112,15 @@ class SegmentationDataSet(BaseDataset):
                 self.samples_with_label.append((image, label))
 
             else:
-                self.background_samples.append((image, label))
+                self.background_samples.append((image, MaskLabel()))  # Empty label
 
         logger.info(f'samples_with_label: {len(self.samples_with_label)}')
         logger.info(f'background_samples: {len(self.background_samples)}')
 
     def cache_images_to_memory(self) -> None:
+        # Masks are kept run-length encoded, all background samples share one empty mask
+        background_mask: RLEMask = rle_encode(np.zeros((self._hw[0], self._hw[1], 1), dtype=np.uint8))
+        mask_bytes = 0
 
         image: Image
         label: MaskLabel
@@ -101,15 +129,22 @@ class SegmentationDataSet(BaseDataset):
                 im = self._load_image(image.path)
                 iw, ih = get_image_wh(im)
                 image.data = letterbox(im, self._wh)
-                label.mask = self.get_mask(label.objects, (iw, ih))
+                if label.is_background:
+                    label.mask = background_mask
+                else:
+                    label.mask = rle_encode(self.get_mask(label.objects, (iw, ih)))
+                    mask_bytes += label.mask.nbytes
 
         if len(self.background_samples) > 0:
             for image, label in tqdm(self.background_samples, desc='Preload Background'):
                 im = self._load_image(image.path)
                 image.data = letterbox(im, self._wh)
-                label.mask = np.zeros((self._hw[0], self._hw[1], 1), dtype=np.uint8)
+                label.mask = background_mask
 
-    def get_mask(self, objects: list, image_wh: Tuple[int, int]) -> np.ndarray:
+        dense_bytes = (len(self.samples_with_label) + len(self.background_samples)) * self._hw[0] * self._hw[1]
+        logger.info(f'Mask memory: {mask_bytes / 1024 ** 2:.2f}MB (dense: {dense_bytes / 1024 ** 2:.2f}MB)')
+
+    def get_mask(self, objects: List[Shape], image_wh: Tuple[int, int]) -> np.ndarray:
 
         iw, ih = image_wh[0], image_wh[1]  # image wh
         ow, oh = self._wh[0], self._wh[1]  # input wh
@@ -121,26 +156,44 @@ class SegmentationDataSet(BaseDataset):
         for obj in objects:
             # points:[[x,y],[x,y],...]
 
-            points = np.array(obj["points"], dtype=float)
+            points = obj.points.astype(float)  # copy, obj.points is reused
 
             if (iw, ih) != (ow, oh):
                 points /= np.array([iw, ih], dtype=float)  # x/iw y/ih
                 points *= np.array([ow, oh], dtype=float)  # x*ow y*oh
                 points = safe_round(points)
 
-            mask = self.polygon2mask(mask, points, self._labels[obj['label']])
+            mask = self.polygon2mask(mask, points, self._labels[obj.label])
 
         # (H,W)->(H,W,C) C=1
         mask = hw_to_hw1(mask)
 
         return mask
 
+    def load_mask(self, label: MaskLabel, image_wh: Tuple[int, int]) -> np.ndarray:
+        if self._mask_cache is None or label.is_background or not label.path:
+            return self.get_mask(label.objects, image_wh)
+
+        mtime = os.stat(label.path).st_mtime_ns
+        if mtime != label.mtime:
+            # json was edited after indexing
+            label.set_metadata(load_labelme_json(label.path))
+            label.mtime = mtime
+
+        mask = self._mask_cache.get(label.path, mtime, image_wh)
+        if mask is None:
+            mask = self.get_mask(label.objects, image_wh)
+            self._mask_cache.put(label.path, mtime, image_wh, mask)
+
+        return mask
+
     @staticmethod
     def polygon2mask(mask: np.ndarray, points: np.ndarray, label_idx: Optional[int] = 0) -> np.ndarray:
         assert 0 <= label_idx <= 255, '255 >= label_idx >= 0'
         if points.dtype != np.int32:
             points = points.astype(np.int32)
-        cv2.fillConvexPoly(mask, points, color=label_idx)  # noqa
+        # fillPoly also handles non-convex polygons
+        cv2.fillPoly(mask, [points], color=label_idx)  # noqa
         return mask
 
     def __getitem__(self, index: int) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -152,7 +205,7 @@ class SegmentationDataSet(BaseDataset):
 
         im = image.data if self._use_cache else self._load_image(image.path)
         iw, ih = get_image_wh(im)
-        mask = label.mask if self._use_cache else self.get_mask(label.objects, (iw, ih))
+        mask = label.mask.decode() if self._use_cache else self.load_mask(label, (iw, ih))
 
         im, mask = self._transform((im, mask))
 
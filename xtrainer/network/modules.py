@@ -1,8 +1,114 @@
 import torch
+from torch import Tensor
 import torch.nn as nn
 import random
 
-__all__ = ['Hswish', 'Hsigmoid', 'Identity', 'SEModule', 'SPPF']
+__all__ = ['Hswish', 'Hsigmoid', 'Identity', 'SEModule', 'SPPF', 'channel_shuffle', 'concat_shuffle',
+           'InvertedResidual']
+
+
+def _is_channels_last(x: Tensor) -> bool:
+    return not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last)
+
+
+def channel_shuffle(x: Tensor, groups: int) -> Tensor:
+    batchsize, num_channels, height, width = x.size()
+    channels_per_group = num_channels // groups
+
+    if _is_channels_last(x):
+        # NHWC: shuffle the innermost channel dim, the output stays channels_last
+        x = x.permute(0, 2, 3, 1)
+        x = x.view(batchsize, height, width, groups, channels_per_group)
+        x = torch.transpose(x, 3, 4).contiguous()
+        x = x.view(batchsize, height, width, num_channels)
+        return x.permute(0, 3, 1, 2)
+
+    # reshape
+    x = x.view(batchsize, groups,
+               channels_per_group, height, width)
+
+    x = torch.transpose(x, 1, 2).contiguous()
+
+    # flatten
+    x = x.view(batchsize, -1, height, width)
+
+    return x
+
+
+def concat_shuffle(x1: Tensor, x2: Tensor) -> Tensor:
+    """
+    Equal to channel_shuffle(torch.cat((x1, x2), dim=1), 2) with a single copy:
+    out[:, 2i] = x1[:, i], out[:, 2i+1] = x2[:, i]
+    """
+    if _is_channels_last(x2):
+        # (N,H,W,C/2,2) -> (N,H,W,C) -> channels_last (N,C,H,W)
+        out = torch.stack((x1.permute(0, 2, 3, 1), x2.permute(0, 2, 3, 1)), dim=4)
+        return out.flatten(3).permute(0, 3, 1, 2)
+
+    # (N,C/2,2,H,W) -> (N,C,H,W)
+    out = torch.stack((x1, x2), dim=2)
+    return out.flatten(1, 2)
+
+
+class InvertedResidual(nn.Module):
+    def __init__(
+        self,
+        inp: int,
+        oup: int,
+        stride: int
+    ) -> None:
+        super(InvertedResidual, self).__init__()
+
+        if not (1 <= stride <= 3):
+            raise ValueError('illegal stride value')
+        self.stride = stride
+
+        branch_features = oup // 2
+        assert (self.stride != 1) or (inp == branch_features << 1)
+
+        if self.stride > 1:
+            self.branch1 = nn.Sequential(
+                self.depthwise_conv(inp, inp, kernel_size=3, stride=self.stride, padding=1),
+                nn.BatchNorm2d(inp),
+                nn.Conv2d(inp, branch_features, kernel_size=1, stride=1, padding=0, bias=False),
+                nn.BatchNorm2d(branch_features),
+                nn.ReLU(inplace=True),
+            )
+        else:
+            self.branch1 = nn.Sequential()
+
+        self.branch2 = nn.Sequential(
+            nn.Conv2d(inp if (self.stride > 1) else branch_features,
+                      branch_features, kernel_size=1, stride=1, padding=0, bias=False),
+            nn.BatchNorm2d(branch_features),
+            nn.ReLU(inplace=True),
+            self.depthwise_conv(branch_features, branch_features, kernel_size=3, stride=self.stride, padding=1),
+            nn.BatchNorm2d(branch_features),
+            nn.Conv2d(branch_features, branch_features, kernel_size=1, stride=1, padding=0, bias=False),
+            nn.BatchNorm2d(branch_features),
+            nn.ReLU(inplace=True),
+        )
+
+    @staticmethod
+    def depthwise_conv(
+        i: int,
+        o: int,
+        kernel_size: int,
+        stride: int = 1,
+        padding: int = 0,
+        bias: bool = False
+    ) -> nn.Conv2d:
+        return nn.Conv2d(i, o, kernel_size, stride, padding, bias=bias, groups=i)
+
+    def forward(self, x: Tensor) -> Tensor:
+        # cat + channel_shuffle are written into one output, x1 is a view of x (no chunk copy)
+        if self.stride == 1:
+            x1, x2 = x.chunk(2, dim=1)
+            out = concat_shuffle(x1, self.branch2(x2))
+        else:
+            out = concat_shuffle(self.branch1(x), self.branch2(x))
+
+        return out
 
 
 class Hswish(nn.Module):
@@ -137,3 +243,41 @@ class MultiSampleDropout(nn.Module):
             logits = logits / self.dropout_num
 
         return logits
+
+
+if __name__ == '__main__':
+    # Numerical equivalence with the reference block: torch.cat -> channel_shuffle
+    def reference_forward(block: InvertedResidual, x: Tensor) -> Tensor:
+        if block.stride == 1:
+            x1, x2 = x.chunk(2, dim=1)
+            out = torch.cat((x1, block.branch2(x2)), dim=1)
+        else:
+            out = torch.cat((block.branch1(x), block.branch2(x)), dim=1)
+        return channel_shuffle(out, 2)
+
+
+    torch.manual_seed(0)
+    for memory_format in [torch.contiguous_format, torch.channels_last]:
+        for inp, oup, stride in [(24, 116, 2), (116, 116, 1)]:
+            block = InvertedResidual(inp, oup, stride).to(memory_format=memory_format)
+            for training in [True, False]:
+                block.train(training)
+                data = torch.randn(2, inp, 32, 32).contiguous(memory_format=memory_format)
+
+                x_ref = data.clone().requires_grad_(True)
+                y_ref = reference_forward(block, x_ref)
+                y_ref.square().sum().backward()
+                grads_ref = [p.grad.clone() for p in block.parameters()]
+                block.zero_grad()
+
+                x = data.clone().requires_grad_(True)
+                y = block(x)
+                y.square().sum().backward()
+                grads = [p.grad.clone() for p in block.parameters()]
+                block.zero_grad()
+
+                assert torch.allclose(y, y_ref, atol=1e-6), 'forward mismatch'
+                assert torch.allclose(x.grad, x_ref.grad, atol=1e-5), 'input grad mismatch'
+                assert all(torch.allclose(g, g_ref, atol=1e-4) for g, g_ref in zip(grads, grads_ref))
+                assert y.is_contiguous(memory_format=memory_format)
+                print(f'{memory_format} inp={inp} oup={oup} stride={stride} training={training}: OK')
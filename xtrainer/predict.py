@@ -10,9 +10,10 @@ from loguru import logger
 
 from xtrainer.utils.task import Task
 from xtrainer.core.model import Model
+from xtrainer.core.weights import is_inference_weights, read_inference_header
 from xtrainer import CONFIG, COLOR_LIST
 from xtrainer.core.preprocess import InferT
-from xtrainer.utils.torch_utils import ToDevice
+from xtrainer.utils.torch_utils import ToDevice, get_memory_format
 from xtrainer.utils.labels import Labels
 from xtrainer.utils.common import (
     error_exit,
@@ -33,15 +34,19 @@ class Predictor:
 
         # Init Model --------------------------------------------------------------------------------------------------
         self.model: Model = None  # noqa
+        self.weight_meta: dict = {}  # header of .xtw weights, overrides model/classes/wh/labels of the config
+        self.num_classes = 0
+        self.mask_classes = 0  # with the background
         self.init_model()
 
         # Init Model --------------------------------------------------------------------------------------------------
-        self.transform = InferT(tuple(CONFIG['wh']))
-        self.to_device = ToDevice(CONFIG['device'])
+        self.transform = InferT(tuple(self.weight_meta.get('wh') or CONFIG['wh']))
+        self.to_device = ToDevice(CONFIG['device'], self.model.memory_format)
 
         # Init label --------------------------------------------------------------------------------------------------
         self.cls_label: Labels = None  # noqa
         self.seg_label: Labels = None  # noqa
+        self.seg_label_offset = 1  # seg_label index of mask channel i: i - offset (0: labels include the background)
         self.load_label()
 
         # Init output dir ----------------------------------------------------------------------------------------------
@@ -68,9 +73,23 @@ class Predictor:
 
     def load_label(self) -> None:
         if self.task.CLS or self.task.MT:
-            self.cls_label = Labels(CONFIG['classification.labels'])
+            self.cls_label = Labels(self.weight_meta.get('cls_labels') or CONFIG['classification.labels'])
         if self.task.SEG or self.task.MT:
-            self.cls_label = Labels(CONFIG['segmentation.labels'])
+            self.seg_label = Labels(self.weight_meta.get('seg_labels') or CONFIG['segmentation.labels'])
+            self.check_seg_label()
+
+    def check_seg_label(self) -> None:
+        # The mask channels come from the weights, labels/thresholds must cover every foreground channel
+        num_fg = self.mask_classes - 1
+        if self.seg_label.nc == self.mask_classes:
+            self.seg_label_offset = 0
+        elif self.seg_label.nc != num_fg:
+            logger.error(f'segmentation labels: {self.seg_label.nc}, model mask_classes: {self.mask_classes}.')
+            error_exit()
+
+        if len(CONFIG['seg_thr'] or []) != num_fg:
+            logger.error(f'seg_thr needs {num_fg} thresholds (without background), but got {CONFIG["seg_thr"]}.')
+            error_exit()
 
     def run(self) -> None:
         images: List[str] = get_images(CONFIG['source'])
@@ -106,6 +125,7 @@ class Predictor:
 
     def preprocess(self, image: str) -> torch.Tensor:
         im = self.imread(image)
+        # InferT reuses its pinned output tensor, the previous H2D copy is done once its results are read back
         im = self.transform(im)
         im = im.unsqueeze(0)
         im = self.to_device(im)
@@ -163,11 +183,10 @@ class Predictor:
 
         no_result = True
         record = {'image': image}
-        nc = CONFIG['segmentation.classes'] + 1  # +1 = +background
 
-        for label_idx in range(1, nc):  # ignore background pixel
+        for label_idx in range(1, self.mask_classes):  # ignore background pixel
             thr = CONFIG['seg_thr'][label_idx - 1]
-            label = self.seg_label[label_idx - 1]
+            label = self.seg_label[label_idx - self.seg_label_offset]
 
             color = tuple(map(int, COLOR_LIST[label_idx]))
 
@@ -222,20 +241,33 @@ class Predictor:
         self.segmentation(seg_output, image)
 
     def init_model(self) -> None:
-        num_classes: int = CONFIG['classification.classes']
-        mask_classes: int = CONFIG['segmentation.classes'] + 1
+        model_name: str = CONFIG['model']
+        num_classes: int = CONFIG['classification.classes'] or 0
+        mask_classes: int = CONFIG['segmentation.classes'] + 1 if CONFIG['segmentation.classes'] else 0
+
+        if is_inference_weights(CONFIG['test_weight']):
+            # Only the json header is read here, tensors are memory mapped by Model.load_weight
+            self.weight_meta = read_inference_header(CONFIG['test_weight'])
+            model_name = self.weight_meta.get('model_name') or model_name
+            num_classes = self.weight_meta.get('num_classes') or num_classes
+            mask_classes = self.weight_meta.get('mask_classes') or mask_classes
+            logger.info(f'Inference weights: {model_name}, num_classes={num_classes}, mask_classes={mask_classes}.')
 
         if num_classes == mask_classes == 0:
             logger.error("num_classes == mask_classes == 0")
             error_exit()
+        self.num_classes = num_classes
+        self.mask_classes = mask_classes
 
         self.model = Model(
-            CONFIG['model'],
+            model_name,
             num_classes,
             mask_classes,
             CONFIG["pretrained"],
             CONFIG['test_weight'],
-            CONFIG['device']
+            CONFIG['device'],
+            memory_format=get_memory_format(CONFIG['memory_format']),
+            prefix_map=CONFIG['weight_prefix_map']
         )
         self.model.init()
         self.model.eval()
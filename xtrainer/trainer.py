@@ -1,12 +1,12 @@
 import os
-from copy import deepcopy
-from typing import Union, List
+import math
+from typing import Union, List, Optional, Callable, Tuple, Dict, Any
 
 import torch
 import numpy as np
 from loguru import logger
-from torch.utils.data import DataLoader
-from mlflow import log_metric
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
+import mlflow
 
 from xtrainer.core.lr_scheduler import LRSchedulerWrapper
 from xtrainer.core.preprocess import (
@@ -14,26 +14,37 @@ from xtrainer.core.preprocess import (
     ClsTargetT,
     ClsValT,
     SegImageT,
-    SegValT
+    SegBatchImageT,
+    SegBatchT,
+    SegValT,
+    BatchNormT
 )
 
 from xtrainer import CONFIG, DEFAULT_OPTIMIZER
 
 from xtrainer.core.model import Model
+from xtrainer.core.ema import ModelEMA
+from xtrainer.core.autotune import batch_candidates, probe_batch_size, probe_loader
+from xtrainer.core.checkpoint import CheckpointManager, snapshot
 from xtrainer.core.optim import (
     AMPOptimWrapper,
     OptimWrapper,
+    build_param_groups,
     build_optimizer_wrapper,
-    build_amp_optimizer_wrapper
+    build_amp_optimizer_wrapper,
+    get_amp_dtype
 )
 
 from xtrainer.dataset.segmentation import SegmentationDataSet
 from xtrainer.dataset.classification import ClassificationDataset, BalancedBatchSampler
+from xtrainer.dataset.loader import build_dataloader, fast_collate, DataPrefetcher
 from xtrainer.utils.labels import Labels
 from xtrainer.utils.common import (
     round4,
     round8,
     timer,
+    save_json,
+    save_yaml,
     print_of_mt,
     print_of_seg,
     print_of_cls,
@@ -41,6 +52,7 @@ from xtrainer.utils.common import (
 
 from xtrainer.core.loss import ClassificationLoss, SegmentationLoss
 from xtrainer.utils.task import Task
+from xtrainer.utils.profiler import StepProfiler
 from xtrainer.utils.perf import (
     topk_accuracy,
     compute_confusion_matrix_classification,
@@ -54,11 +66,32 @@ from xtrainer.utils.tracker import (
     SegTrainTracker,
     SegValTracker
 )
+from xtrainer.utils.dist import (
+    is_dist,
+    get_rank,
+    get_world_size,
+    is_main_process,
+    all_reduce_sum,
+    broadcast_object,
+    main_process_only
+)
 from xtrainer.utils.torch_utils import (
     loss_sum,
-    convert_optimizer_state_dict_to_fp16
+    init_seeds,
+    get_memory_format,
+    get_rng_state,
+    set_rng_state,
+    convert_optimizer_state_dict_to_fp16,
+    convert_optimizer_state_dict_to_fp32
 )
 
+# Distributed: only rank 0 talks to mlflow, draws figures and prints the epoch table
+log_metric = main_process_only(mlflow.log_metric)
+draw_confusion_matrix = main_process_only(draw_confusion_matrix)
+print_of_cls = main_process_only(print_of_cls)
+print_of_seg = main_process_only(print_of_seg)
+print_of_mt = main_process_only(print_of_mt)
+
 
 class BaseTrainer:
     def __init__(self):
@@ -73,6 +106,7 @@ class BaseTrainer:
         self.loss: Union[ClassificationLoss, SegmentationLoss] = None  # noqa
         self.optimizer: Union[OptimWrapper, AMPOptimWrapper] = None  # noqa
         self.lr_scheduler: LRSchedulerWrapper = None  # noqa
+        self.ema: Optional[ModelEMA] = None  # val and checkpoints use the ema weights when enabled
 
         self.train_ds: Union[ClassificationDataset, SegmentationDataSet] = None  # noqa
         self.val_ds: Union[ClassificationDataset, SegmentationDataSet] = None  # noqa
@@ -80,9 +114,113 @@ class BaseTrainer:
         self.train_dl: DataLoader = None  # noqa
         self.val_dl: DataLoader = None  # noqa
 
+        # Ops on the collated batch on the model device (augment_backend: batch, uint8_transport)
+        self.batch_transform: Union[SegBatchT, BatchNormT] = None  # noqa
+        self.val_batch_transform: BatchNormT = None  # noqa
+
         self.train_tracker: Union[ClsTrainTracker, SegTrainTracker] = None  # noqa
         self.val_tracker: Union[ClsValTracker, SegValTracker] = None  # noqa
 
+        self.checkpoint_manager: Optional[CheckpointManager] = None
+        self._resume_best_score: Optional[float] = None
+
+        # Per stage step timing, disabled: every stage() is a no-op
+        self.profiler: StepProfiler = StepProfiler('cpu')
+
+        self.batch_key: Optional[str] = None  # CONFIG key of the batch size, i.e. 'classification.batch'
+
+    def init_ds(self) -> None:
+        ...
+
+    def init_dl(self) -> None:
+        ...
+
+    def init_ds_dl(self) -> None:
+        self.init_ds()
+        self.init_dl()
+
+    def criterion(self, outputs: Any, targets: torch.Tensor) -> torch.Tensor:
+        return self.loss(outputs, targets)  # noqa
+
+    def autotune(self) -> Dict[str, Any]:
+        # After init_ds and init_optimizer, before init_dl: the choice is written back into CONFIG
+        if self.batch_key is None:
+            logger.warning(f'Autotune is not supported for {self.task.task}.')
+            return {}
+
+        record = {}
+        if is_main_process():
+            record = self._autotune()
+        # Distributed: every rank uses the rank 0 choice
+        record = broadcast_object(record)
+
+        section, key = self.batch_key.split('.')
+        CONFIG.update({
+            section: dict(CONFIG[section], **{key: record['batch']}),
+            'workers': record['workers'],
+            'prefetch_factor': record['prefetch_factor']
+        })
+        logger.success(
+            f'Autotune: {self.batch_key}={record["batch"]}, workers={record["workers"]}, '
+            f'prefetch_factor={record["prefetch_factor"]}.'
+        )
+
+        if is_main_process():
+            save_json(record, os.path.join(CONFIG['experiment_path'], 'autotune.json'))
+        return record
+
+    def _autotune(self) -> Dict[str, Any]:
+        # A few real samples (actual transforms) tiled to every probed batch size
+        num = min(len(self.train_ds), 8)
+        images, targets = fast_collate([self.train_ds[i] for i in range(num)])
+        images = self.to_device(images)
+        targets = self.to_device(targets)
+
+        net = self.model.net  # without DDP: only this rank runs the probe
+        state = snapshot(self.model.state_dict)  # BN running stats move during the probe
+
+        def step_fn(batch: int) -> None:
+            # forward + loss + backward, no optimizer step (its state is allocated later, keep memory_fraction < 1)
+            reps = math.ceil(batch / num)
+            x = images.repeat(reps, 1, 1, 1)[:batch]
+            y = targets.repeat(reps, *([1] * (targets.dim() - 1)))[:batch]
+            x, y = self.apply_batch_transform(self.batch_transform, x, y)
+            try:
+                with self.optimizer.autocast():
+                    loss = self.criterion(net(x), y)
+                loss.backward()
+            finally:
+                # Also on oom inside backward: partial grads would be added to the first real step
+                net.zero_grad(set_to_none=True)
+
+        self.model.train()
+        steps: int = CONFIG['autotune.steps'] or 5
+        batch, batch_records = probe_batch_size(
+            step_fn,
+            self.model.device,
+            batch_candidates(CONFIG['autotune.max_batch'] or 256),
+            memory_fraction=CONFIG['autotune.memory_fraction'] or 0.85,
+            steps=steps
+        )
+        net.load_state_dict(state)
+
+        (workers, prefetch_factor), loader_records = probe_loader(
+            self.train_ds,
+            batch,
+            CONFIG['autotune.workers'] or [0, 2, 4, 8],
+            CONFIG['autotune.prefetch_factor'] or [2, 4],
+            steps=steps * 4,
+            pin_memory=self.model.is_gpu
+        )
+
+        return {
+            'batch': batch,
+            'workers': workers,
+            'prefetch_factor': prefetch_factor,
+            'batch_probe': batch_records,
+            'loader_probe': loader_records
+        }
+
     def init_model(self) -> None:
         num_classes = 0
         mask_classes = 0
@@ -97,28 +235,36 @@ class BaseTrainer:
             mask_classes=mask_classes,
             pretrained=CONFIG["pretrained"],
             weight=CONFIG['weight'],
-            device=CONFIG['device']
+            device=CONFIG['device'],
+            memory_format=get_memory_format(CONFIG['memory_format']),
+            prefix_map=CONFIG['weight_prefix_map']
         )
         self.model.init()
 
+        if is_dist():
+            self.model.wrap_ddp(CONFIG['sync_bn'])
+
     def init_optimizer(self) -> None:
         name: str = CONFIG["optimizer"]
 
         if name.upper() == 'AUTO':
             name = DEFAULT_OPTIMIZER
 
+        # BN/bias without weight decay, lr multipliers per module prefix (i.e. backbone vs heads)
         args = {
-            "params": [{
-                'params': self.model.parameters,
-                'initial_lr': CONFIG['lr0']
-            }],
+            "params": build_param_groups(
+                self.model.net,
+                CONFIG['lr0'],
+                weight_decay=CONFIG['weight_decay'] or 0.0,
+                lr_mults=CONFIG['lr_mults']
+            ),
             "lr": CONFIG["lr0"],
+            "impl": CONFIG['optimizer_impl'] or 'auto'
         }
 
         if name in ["Adam", "Adamax", "AdamW", "NAdam", "RAdam"]:
             args.update({
-                'betas': (CONFIG['momentum'], 0.999),
-                'weight_decay': 0.0
+                'betas': (CONFIG['momentum'], 0.999)
             })
         elif name == "RMSProp":
             args.update({
@@ -131,26 +277,214 @@ class BaseTrainer:
             })
 
         if CONFIG["amp"]:
-            self.optimizer = build_amp_optimizer_wrapper(name, **args)
-            logger.info('AMP: Open Automatic Mixed Precision(AMP)')
+            device_type: str = self.model.device.type
+            dtype = get_amp_dtype(device_type, CONFIG['amp_dtype'])
+            self.optimizer = build_amp_optimizer_wrapper(name, device_type=device_type, dtype=dtype, **args)
+            logger.info(f'AMP: Open Automatic Mixed Precision(AMP) {device_type}:{dtype}.')
         else:
             self.optimizer = build_optimizer_wrapper(name, **args)
 
         logger.info(f'Build Optim: {name}.')
 
+    def init_ema(self) -> None:
+        # After init_optimizer: updated by the optimizer wrapper after every step
+        if not CONFIG['ema']:
+            return
+
+        self.ema = ModelEMA(
+            self.model.net,
+            decay=CONFIG['ema_decay'] or 0.9999,
+            tau=CONFIG['ema_tau'],
+            interval=CONFIG['ema_interval'] or 1
+        )
+        self.optimizer.set_ema(self.ema)
+        logger.info(f'EMA: decay={self.ema.decay}, tau={self.ema.tau}, interval={self.ema.interval}.')
+
+    def init_profiler(self) -> None:
+        # After init_optimizer: backward/optimizer are timed inside the optimizer wrapper
+        if not CONFIG['profile']:
+            return
+
+        self.profiler = StepProfiler(
+            self.model.device,
+            enabled=True,
+            trace=CONFIG['profile_trace'] and is_main_process(),
+            trace_start=CONFIG['profile_trace_start'] or 10,
+            trace_steps=CONFIG['profile_trace_steps'] or 5,
+            trace_dir=CONFIG['experiment_path']
+        )
+        self.optimizer.set_profiler(self.profiler)
+        logger.info('Step profiler: on.')
+
+    def log_profile(self) -> None:
+        summary = self.profiler.summary()
+        if summary:
+            logger.info(summary)
+
+    def infer(self, images: torch.Tensor) -> Any:
+        # Validation forward
+        if self.ema is not None:
+            return self.ema(images)
+        return self.model(images)
+
+    def steps_per_epoch(self) -> int:
+        # Optimizer steps per epoch
+        return len(self.train_dl)
+
     def init_lr_scheduler(self) -> None:
+        # After init_ds_dl: the schedule is step granular
         self.lr_scheduler = LRSchedulerWrapper(
             self.optimizer.optimizer,
             lrf=CONFIG['lrf'],
             epochs=CONFIG['epochs'],
-            cos_lr=CONFIG['cos_lr']
+            cos_lr=CONFIG['cos_lr'],
+            steps_per_epoch=self.steps_per_epoch(),
+            scheduler=CONFIG['lr_scheduler'] or None,
+            warmup_epochs=CONFIG['warmup_epochs'] or 0,
+            warmup_method=CONFIG['warmup_method'] or 'linear',
+            warmup_factor=CONFIG['warmup_factor'] or 0.001,
+            power=CONFIG['lr_power'] or 0.9,
+            cycles=CONFIG['lr_cycles'] or 1
+        )
+        logger.info(
+            f'LR scheduler: {self.lr_scheduler.scheduler}, {self.lr_scheduler.total_steps} steps, '
+            f'warmup {self.lr_scheduler.warmup_steps} steps.'
         )
 
     def to_device(self, data: torch.Tensor) -> torch.Tensor:
         if self.model.is_gpu:
-            return data.cuda(self.model.device, non_blocking=True)
+            data = data.cuda(self.model.device, non_blocking=True)
+
+        # Only images (N,C,H,W) follow the model memory format
+        if data.dim() == 4 and data.is_floating_point():
+            data = data.contiguous(memory_format=self.model.memory_format)
+
+        return data
+
+    def checkpoint_meta(self) -> dict:
+        # Task specific checkpoint fields (num_classes/mask_classes)
+        return {}
+
+    def checkpoint_dict(self) -> dict:
+        # CPU snapshot of the training state, the only part of saving that blocks training
+        optimizer_fp16: bool = CONFIG['checkpoint_fp16'] is not False
+        state = {
+            'epoch': self.epoch,
+            'state_dict': self.model.state_dict,
+            'model_name': self.model.model_name,
+            **self.checkpoint_meta(),
+            'optimizer': self.optimizer.state_dict(),  # with 'loss_scaler' when amp
+            'optimizer_fp16': optimizer_fp16,
+            'lr': self.optimizer.lrs[0],
+            'lr_scheduler': self.lr_scheduler.state_dict(),
+            'rng_state': get_rng_state()
+        }
+        if self.ema is not None:
+            # predict/export read 'state_dict': the ema weights, the raw weights are kept for resume
+            state['model_state_dict'] = state['state_dict']
+            state['state_dict'] = self.ema.state_dict()
+            state['ema_updates'] = self.ema.updates
+        state = snapshot(state)
+        if optimizer_fp16:
+            convert_optimizer_state_dict_to_fp16(state['optimizer'])  # in place on the snapshot
+        return state
+
+    def val_metrics(self) -> Dict[str, float]:
+        # Metrics of the last val(), read before the trackers are reset
+        return {}
+
+    def val_score(self, metrics: Dict[str, float]) -> Optional[float]:
+        # Single number for best.pth (higher is better)
+        return None
+
+    def save_model(self, metrics: Optional[Dict[str, float]] = None) -> None:
+        if self.checkpoint_manager is None:
+            self.checkpoint_manager = CheckpointManager(
+                CONFIG['weight_path'],
+                save_period=CONFIG['save_period'],
+                keep_last=CONFIG['keep_last'],
+                best_score=self._resume_best_score
+            )
+
+        metrics = metrics or {}
+        score = self.val_score(metrics) if metrics else None
+        self.checkpoint_manager.update(self.checkpoint_dict(), self.epoch, metrics, score)
+
+    def close(self) -> None:
+        # Flush the checkpoints still being written
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.close()
+
+    def resume(self, path: str) -> None:
+        # Continue from the end of the saved epoch: weights, optimizer(+amp scaler), lr scheduler, epoch, rng
+        if os.path.exists(path) is False:
+            raise FileNotFoundError(f'Resume checkpoint is not found: {path}')
+
+        checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+        self.model.net.load_state_dict(checkpoint.get('model_state_dict', checkpoint['state_dict']))
+
+        if self.ema is not None:
+            # checkpoints without ema restart the average from the loaded weights
+            ema_state = checkpoint['state_dict'] if 'model_state_dict' in checkpoint else self.model.state_dict
+            self.ema.load_state_dict(ema_state, checkpoint.get('ema_updates', 0))
+
+        optimizer_state = checkpoint['optimizer']
+        if checkpoint.get('optimizer_fp16', True):
+            optimizer_state = convert_optimizer_state_dict_to_fp32(optimizer_state)
+        self.optimizer.load_state_dict(optimizer_state)
+
+        if 'lr_scheduler' in checkpoint:
+            self.lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+
+        # The samplers are seeded by epoch, the next epoch reshuffles the same way as the original run
+        self.epoch = checkpoint['epoch']
+        self._resume_best_score = checkpoint.get('best_score')  # best.pth is only replaced by a better epoch
+
+        if 'rng_state' in checkpoint and is_main_process():
+            set_rng_state(checkpoint['rng_state'])
         else:
-            return data
+            # Only rank 0 states are saved, the other ranks get fresh per epoch streams
+            init_seeds(CONFIG['seed'] + get_rank() * 100003 + self.epoch)
+
+        logger.info(f'Resume: {path} (epoch {self.epoch}, lr {self.optimizer.lrs[0]:.8f}).')
+
+    @staticmethod
+    def build_sampler(dataset: Dataset, shuffle: bool) -> Optional[DistributedSampler]:
+        # Distributed: every rank reads its own 1/world_size shard (val shards are padded to equal length)
+        if not is_dist():
+            return None
+        return DistributedSampler(dataset, shuffle=shuffle, seed=CONFIG['seed'])
+
+    @staticmethod
+    def set_sampler_epoch(dl: DataLoader, epoch: int) -> None:
+        # Reshuffle DistributedSampler / rebuild BalancedBatchSampler batches for this epoch
+        for sampler in (dl.sampler, dl.batch_sampler):
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+
+    def prefetch(self, dl: DataLoader) -> Union[DataLoader, DataPrefetcher]:
+        # Stage the next batches on the model device while the current step computes
+        if not CONFIG['prefetcher']:
+            return dl
+        return DataPrefetcher(dl, self.model.device, self.model.memory_format)
+
+    @staticmethod
+    def log_data_time(dl: Union[DataLoader, DataPrefetcher]) -> None:
+        if isinstance(dl, DataPrefetcher):
+            logger.info(dl.summary())
+
+    def apply_batch_transform(
+        self,
+        transform: Optional[Callable],
+        images: torch.Tensor,
+        targets: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if transform is None:
+            return images, targets
+
+        images, targets = transform((images, targets))
+        images = self.to_device(images)  # uint8 input skipped the memory format
+        return images, targets
 
 
 class ClassificationTrainer(BaseTrainer):
@@ -159,6 +493,7 @@ class ClassificationTrainer(BaseTrainer):
         self.train_tracker = ClsTrainTracker(topk=np.argmax(CONFIG['topk']))  # noqa
         self.val_tracker = ClsValTracker(topk=np.argmax(CONFIG['topk']))  # noqa
         self.labels = Labels(CONFIG['classification.labels'])
+        self.batch_key = 'classification.batch'
 
     def init_loss(self) -> None:
 
@@ -173,18 +508,22 @@ class ClassificationTrainer(BaseTrainer):
         self.loss = ClassificationLoss(alpha=alpha, gamma=CONFIG['gamma'])
         logger.success('Init Classification Loss.')
 
-    def init_ds_dl(self) -> None:
+    def init_ds(self) -> None:
         wh = tuple(CONFIG['wh'])
-        workers: int = CONFIG['workers']
         use_cache: bool = CONFIG['cache']
-        bs: int = CONFIG['classification.batch']
+        uint8: bool = bool(CONFIG['uint8_transport'])
+
+        if uint8:
+            self.batch_transform = BatchNormT()
+            self.val_batch_transform = BatchNormT()
+            logger.info('Transport: uint8, normalize on the device.')
 
         # Build Train Dataset --------------------------------------------------------------------------------------
         self.train_ds = ClassificationDataset(
             root=CONFIG['classification.train'],
             wh=wh,
             labels=self.labels,
-            transform=ClsImageT(wh),
+            transform=ClsImageT(wh, uint8=uint8),
             target_transform=ClsTargetT(),
             cache=use_cache
         )
@@ -194,7 +533,7 @@ class ClassificationTrainer(BaseTrainer):
             root=CONFIG['classification.val'],
             wh=wh,
             labels=self.labels,
-            transform=ClsValT(wh),
+            transform=ClsValT(wh, uint8=uint8),
             target_transform=ClsTargetT(),
             cache=use_cache
         )
@@ -203,6 +542,10 @@ class ClassificationTrainer(BaseTrainer):
         logger.info(f'Classification Train data size: {self.train_ds.real_data_size}.')
         logger.info(f'Classification Val data size: {self.val_ds.real_data_size}.')
 
+    def init_dl(self) -> None:
+        workers: int = CONFIG['workers']
+        bs: int = CONFIG['classification.batch']
+
         batch_sampler = None
         if bs < self.labels.nc:
             logger.info('Close BalancedBatchSampler.')
@@ -210,28 +553,34 @@ class ClassificationTrainer(BaseTrainer):
             logger.info('Open BalancedBatchSampler')
             batch_sampler = BalancedBatchSampler(
                 self.train_ds.targets,
-                batch_size=bs
+                batch_size=bs,
+                oversample=bool(CONFIG['classification.oversample']),
+                seed=CONFIG['seed'],
+                num_replicas=get_world_size(),
+                rank=get_rank()
             )
 
         # Build Train DataLoader -----------------------------------------------------------------------------------
-        self.train_dl = DataLoader(
+        self.train_dl = build_dataloader(
             dataset=self.train_ds,
-            batch_size=bs if bs < self.labels.nc else 1,
-            num_workers=workers,
-            pin_memory=True,
+            batch_size=bs,
+            workers=workers,
+            shuffle=True,
+            sampler=self.build_sampler(self.train_ds, shuffle=True) if batch_sampler is None else None,
             batch_sampler=batch_sampler,
-            shuffle=True if bs < self.labels.nc else False,
-            drop_last=False,
-            sampler=None
+            persistent_workers=CONFIG['persistent_workers'],
+            prefetch_factor=CONFIG['prefetch_factor']
         )
         logger.success('Init classification train dataloader.')
 
-        self.val_dl = DataLoader(
+        self.val_dl = build_dataloader(
             dataset=self.val_ds,
             batch_size=bs,
-            num_workers=workers,
-            pin_memory=True,
-            shuffle=False
+            workers=workers,
+            shuffle=False,
+            sampler=self.build_sampler(self.val_ds, shuffle=False),
+            persistent_workers=CONFIG['persistent_workers'],
+            prefetch_factor=CONFIG['prefetch_factor']
         )
         logger.success('Init classification val dataloader.')
 
@@ -239,37 +588,50 @@ class ClassificationTrainer(BaseTrainer):
 
         self.model.train()
 
+        self.set_sampler_epoch(self.train_dl, self.epoch)
+
+        train_dl = self.prefetch(self.train_dl)
         datas: tuple
-        for curr_step, datas in enumerate(self.train_dl):
-            images, targets = datas
-            images = self.to_device(images)
-            targets = self.to_device(targets)
-            loss = self.forward(images, targets)
+        for curr_step, datas in enumerate(self.profiler.iter(train_dl)):
+            with self.profiler.stage('h2d'):
+                images, targets = datas
+                images = self.to_device(images)
+                targets = self.to_device(targets)
+                images, targets = self.apply_batch_transform(self.batch_transform, images, targets)
+
+            with self.optimizer.autocast():
+                loss = self.forward(images, targets)
 
             with self.optimizer.context() as opt:
                 opt.update(loss)
+            self.lr_scheduler.update()
 
-        self.lr_scheduler.update()
+        self.log_data_time(train_dl)
+        self.log_profile()
+        self.train_tracker.all_reduce()
 
     def forward(self, images: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
-        with self.optimizer.context():
+        with self.profiler.stage('forward'):
             outputs = self.model(images)
-            loss = self.loss(outputs, targets)  # noqa
+        with self.profiler.stage('loss'):
+            loss = self.criterion(outputs, targets)
 
-        topk: List[float] = topk_accuracy(outputs, targets, CONFIG['topk'])
+        with self.profiler.stage('metric'):
+            topk: List[float] = topk_accuracy(outputs, targets, CONFIG['topk'])
 
-        maxk = max(CONFIG["topk"])
-        maxk_idx = np.argmax(CONFIG["topk"])
+            maxk = max(CONFIG["topk"])
+            maxk_idx = np.argmax(CONFIG["topk"])
 
-        top1_val = topk[0]
-        topk_val = topk[maxk_idx]
+            top1_val = topk[0]
+            topk_val = topk[maxk_idx]
 
-        self.train_tracker.top1.add(top1_val)
-        self.train_tracker.topk.add(topk_val)
-        self.train_tracker.loss.add(loss.cpu().detach())
+            self.train_tracker.top1.add(top1_val)
+            self.train_tracker.topk.add(topk_val)
+            self.train_tracker.loss.add(loss.cpu().detach())
 
-        log_metric('Train Batch Top1', top1_val)
-        log_metric(f'Train Batch Top{maxk}', topk_val)
+        with self.profiler.stage('log'):
+            log_metric('Train Batch Top1', top1_val)
+            log_metric(f'Train Batch Top{maxk}', topk_val)
 
         return loss
 
@@ -281,12 +643,13 @@ class ClassificationTrainer(BaseTrainer):
 
         confusion_matrix = 0
 
-        for data in self.val_dl:
+        for data in self.prefetch(self.val_dl):
             images, targets = data
             images = self.to_device(images)
             targets = self.to_device(targets)
+            images, targets = self.apply_batch_transform(self.val_batch_transform, images, targets)
 
-            output = self.model(images)  # [[cls1,cls2],[seg1,seg2,...]]
+            output = self.infer(images)  # [[cls1,cls2],[seg1,seg2,...]]
 
             confusion_matrix += compute_confusion_matrix_classification(output, targets, self.labels.nc)
             topk: List[float] = topk_accuracy(output, targets, CONFIG['topk'])
@@ -297,6 +660,11 @@ class ClassificationTrainer(BaseTrainer):
             self.val_tracker.top1.add(top1_val)
             self.val_tracker.topk.add(topk_val)
 
+        # Distributed: merge the matrices and metrics of every rank
+        if isinstance(confusion_matrix, torch.Tensor):
+            confusion_matrix = all_reduce_sum(confusion_matrix)
+        self.val_tracker.all_reduce()
+
         draw_confusion_matrix(
             confusion_matrix,
             self.labels.labels,
@@ -307,18 +675,19 @@ class ClassificationTrainer(BaseTrainer):
         log_metric('Val Epoch Top1', total_top1)
         log_metric(f'Val Epoch Top{maxk}', total_topk)
 
-    def save_model(self) -> None:
-
-        save_dict = {
-            'epoch': self.epoch,
-            'state_dict': self.model.state_dict,
-            'model_name': self.model.model_name,
-            'num_classes': self.labels.nc,
-            'optimizer': convert_optimizer_state_dict_to_fp16(deepcopy(self.optimizer.state_dict())),
-            'lr': self.optimizer.lrs[0]
+    def val_metrics(self) -> Dict[str, float]:
+        if self.val_tracker.top1.size == 0:
+            return {}
+        return {
+            'top1': self.val_tracker.top1.avg,
+            f'top{max(CONFIG["topk"])}': self.val_tracker.topk.avg
         }
-        save_path = os.path.join(CONFIG['weight_path'], f'epoch{self.epoch}.pth')
-        torch.save(save_dict, save_path)
+
+    def val_score(self, metrics: Dict[str, float]) -> Optional[float]:
+        return metrics.get('top1')
+
+    def checkpoint_meta(self) -> dict:
+        return {'num_classes': self.labels.nc}
 
 
 class SegmentationTrainer(BaseTrainer):
@@ -327,19 +696,37 @@ class SegmentationTrainer(BaseTrainer):
         self.train_tracker = SegTrainTracker()
         self.val_tracker = SegValTracker()
         self.labels = Labels(CONFIG['segmentation.labels'])
+        self.batch_key = 'segmentation.batch'
 
-    def init_ds_dl(self) -> None:
+    def init_ds(self) -> None:
         wh = tuple(CONFIG['wh'])
-        workers: int = CONFIG['workers']
         use_cache: bool = CONFIG['cache']
-        bs: int = CONFIG['segmentation.batch']
+        uint8: bool = bool(CONFIG['uint8_transport'])
+
+        if CONFIG['augment_backend'] == 'batch':
+            train_transform = SegBatchImageT(wh)
+            self.batch_transform = SegBatchT()
+            logger.info('Augment backend: batch.')
+        else:
+            train_transform = SegImageT(wh, uint8=uint8)
+            if uint8:
+                self.batch_transform = BatchNormT()
+
+        if uint8:
+            self.val_batch_transform = BatchNormT()
+            logger.info('Transport: uint8, normalize on the device.')
+
+        mask_cache_dir = None
+        if CONFIG['mask_cache']:
+            mask_cache_dir = CONFIG['mask_cache_dir'] or os.path.join(CONFIG['experiment_path'], 'mask_cache')
 
         self.train_ds = SegmentationDataSet(
             root=CONFIG['segmentation.train'],
             wh=wh,
             labels=self.labels,
-            transform=SegImageT(wh),
-            cache=use_cache
+            transform=train_transform,
+            cache=use_cache,
+            mask_cache_dir=mask_cache_dir
         )
         logger.success('Init segmentation train dataset.')
 
@@ -347,68 +734,96 @@ class SegmentationTrainer(BaseTrainer):
             root=CONFIG['segmentation.val'],
             wh=wh,
             labels=self.labels,
-            transform=SegValT(wh),
-            cache=use_cache
+            transform=SegValT(wh, uint8=uint8),
+            cache=use_cache,
+            mask_cache_dir=mask_cache_dir
         )
         logger.success('Init segmentation val dataset.')
 
         background_size = len(self.train_ds.background_samples)
         logger.info(
             f'Segmentation Train data size: {self.train_ds.real_data_size} (background:{background_size}).')
+        logger.info(f'Segmentation Val data size: {self.val_ds.real_data_size}.')
+
+    def init_dl(self) -> None:
+        workers: int = CONFIG['workers']
+        bs: int = CONFIG['segmentation.batch']
 
-        self.train_dl = DataLoader(
+        self.train_dl = build_dataloader(
             dataset=self.train_ds,
             batch_size=bs,
+            workers=workers,
             shuffle=False,
-            num_workers=workers,
-            pin_memory=True,
+            sampler=self.build_sampler(self.train_ds, shuffle=False),
+            persistent_workers=CONFIG['persistent_workers'],
+            prefetch_factor=CONFIG['prefetch_factor']
         )
         logger.success('Init segmentation train dataloader.')
 
-        self.val_dl = DataLoader(
+        self.val_dl = build_dataloader(
             dataset=self.val_ds,
             batch_size=bs,
+            workers=workers,
             shuffle=False,
-            num_workers=workers,
-            pin_memory=True,
+            sampler=self.build_sampler(self.val_ds, shuffle=False),
+            persistent_workers=CONFIG['persistent_workers'],
+            prefetch_factor=CONFIG['prefetch_factor']
         )
         logger.success('Init segmentation val dataloader.')
-        logger.info(f'Segmentation Val data size: {self.val_ds.real_data_size}.')
 
     def init_loss(self) -> None:
         self.loss = SegmentationLoss(CONFIG['seg_loss_sum_weights'])
         logger.success('Init segmentation loss.')
 
+    def criterion(self, outputs: Any, targets: torch.Tensor) -> torch.Tensor:
+        # segmentation output=[x1,x2,x3,x4], deep supervision
+        loss1 = 1 * self.loss(outputs[0], targets)  # noqa
+        loss2 = 1 * self.loss(outputs[1], targets)  # noqa
+        loss3 = 0.5 * self.loss(outputs[2], targets)  # noqa
+        loss4 = 0.5 * self.loss(outputs[3], targets)  # noqa
+
+        return loss1 + loss2 + loss3 + loss4
+
     def train(self) -> None:
         self.model.train()
+        self.set_sampler_epoch(self.train_dl, self.epoch)
+
+        train_dl = self.prefetch(self.train_dl)
         datas: tuple
-        for curr_step, datas in enumerate(self.train_dl):
-            images, targets = datas
-            images = self.to_device(images)
-            targets = self.to_device(targets)
-            loss = self.forward(images, targets)
+        for curr_step, datas in enumerate(self.profiler.iter(train_dl)):
+            with self.profiler.stage('h2d'):
+                images, targets = datas
+                images = self.to_device(images)
+                targets = self.to_device(targets)
+                images, targets = self.apply_batch_transform(self.batch_transform, images, targets)
+
+            with self.optimizer.autocast():
+                loss = self.forward(images, targets)
 
             with self.optimizer.context() as opt:
                 opt.update(loss)
+            self.lr_scheduler.update()
 
-        self.lr_scheduler.update()
+        self.log_data_time(train_dl)
+        self.log_profile()
+        self.train_tracker.all_reduce()
 
     def forward(self, images: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
-        with self.optimizer.context():
-            # segmentation output=[x1,x2,x3,x4]
+        # segmentation output=[x1,x2,x3,x4]
+        with self.profiler.stage('forward'):
             outputs = self.model(images)
-            loss1 = 1 * self.loss(outputs[0], targets)  # noqa
-            loss2 = 1 * self.loss(outputs[1], targets)  # noqa
-            loss3 = 0.5 * self.loss(outputs[2], targets)  # noqa
-            loss4 = 0.5 * self.loss(outputs[3], targets)  # noqa
 
-        loss = loss1 + loss2 + loss3 + loss4
+        with self.profiler.stage('loss'):
+            loss = self.criterion(outputs, targets)
+
+        with self.profiler.stage('metric'):
+            miou: float = compute_iou(outputs[0], targets, self.labels.nc)
 
-        miou: float = compute_iou(outputs[0], targets, self.labels.nc)
+            self.train_tracker.miou.add(miou)
+            self.train_tracker.loss.add(loss.cpu().detach())  # noqa
 
-        self.train_tracker.miou.add(miou)
-        self.train_tracker.loss.add(loss.cpu().detach())  # noqa
-        log_metric('Train Batch MIoU', miou)
+        with self.profiler.stage('log'):
+            log_metric('Train Batch MIoU', miou)
 
         return loss
 
@@ -416,18 +831,24 @@ class SegmentationTrainer(BaseTrainer):
         self.model.eval()
 
         confusion_matrix = 0
-        for data in self.val_dl:
+        for data in self.prefetch(self.val_dl):
             images, targets = data
             images = self.to_device(images)
             targets = self.to_device(targets)  # target.shape=(N,1,H,W)
+            images, targets = self.apply_batch_transform(self.val_batch_transform, images, targets)
 
-            output = self.model(images)
+            output = self.infer(images)
 
             miou: float = compute_iou(output[0], targets, self.labels.nc)
             self.val_tracker.miou.add(miou)
 
             confusion_matrix += compute_confusion_matrix_segmentation(output[0], targets, self.labels.nc)
 
+        # Distributed: merge the matrices and metrics of every rank
+        if isinstance(confusion_matrix, torch.Tensor):
+            confusion_matrix = all_reduce_sum(confusion_matrix)
+        self.val_tracker.all_reduce()
+
         draw_confusion_matrix(
             confusion_matrix,
             self.labels.labels,
@@ -436,18 +857,16 @@ class SegmentationTrainer(BaseTrainer):
         total_miou: float = self.val_tracker.miou.avg
         log_metric('Val Epoch MIoU', total_miou)
 
-    def save_model(self) -> None:
+    def val_metrics(self) -> Dict[str, float]:
+        if self.val_tracker.miou.size == 0:
+            return {}
+        return {'miou': self.val_tracker.miou.avg}
 
-        save_dict = {
-            'epoch': self.epoch,
-            'state_dict': self.model.state_dict,
-            'model_name': self.model.model_name,
-            'mask_classes': self.labels.nc,
-            'optimizer': convert_optimizer_state_dict_to_fp16(deepcopy(self.optimizer.state_dict())),
-            'lr': self.optimizer.lrs[0]
-        }
-        save_path = os.path.join(CONFIG['weight_path'], f'epoch{self.epoch}.pth')
-        torch.save(save_dict, save_path)
+    def val_score(self, metrics: Dict[str, float]) -> Optional[float]:
+        return metrics.get('miou')
+
+    def checkpoint_meta(self) -> dict:
+        return {'mask_classes': self.labels.nc}
 
 
 class MultiTaskTrainer(BaseTrainer):
@@ -458,9 +877,13 @@ class MultiTaskTrainer(BaseTrainer):
         self.init_ds_dl()
         self.init_loss()
 
-    def init_ds_dl(self) -> None:
-        self.cls_trainer.init_ds_dl()
-        self.seg_trainer.init_ds_dl()
+    def init_ds(self) -> None:
+        self.cls_trainer.init_ds()
+        self.seg_trainer.init_ds()
+
+    def init_dl(self) -> None:
+        self.cls_trainer.init_dl()
+        self.seg_trainer.init_dl()
 
     def init_loss(self) -> None:
         self.cls_trainer.init_loss()
@@ -469,14 +892,16 @@ class MultiTaskTrainer(BaseTrainer):
     def train(self) -> None:
         self.model.train()
 
-        dataloaders: List[DataLoader] = []
+        dataloaders: List[Union[DataLoader, DataPrefetcher]] = []
         if self.task.CLS or self.task.MT:
-            dataloaders.append(self.cls_trainer.train_dl)
+            self.set_sampler_epoch(self.cls_trainer.train_dl, self.epoch)
+            dataloaders.append(self.prefetch(self.cls_trainer.train_dl))
         if self.task.SEG or self.task.MT:
-            dataloaders.append(self.seg_trainer.train_dl)
+            self.set_sampler_epoch(self.seg_trainer.train_dl, self.epoch)
+            dataloaders.append(self.prefetch(self.seg_trainer.train_dl))
 
         datas: tuple
-        for curr_step, datas in enumerate(zip(*dataloaders)):
+        for curr_step, datas in enumerate(self.profiler.iter(zip(*dataloaders))):
 
             if self.task.MT:
                 cls_data, seg_data = datas
@@ -490,13 +915,17 @@ class MultiTaskTrainer(BaseTrainer):
                 images, targets = cls_data
                 images = self.to_device(images)
                 targets = self.to_device(targets)
-                cls_loss = self.cls_trainer.forward(images, targets)
+                images, targets = self.apply_batch_transform(self.cls_trainer.batch_transform, images, targets)
+                with self.optimizer.autocast():
+                    cls_loss = self.cls_trainer.forward(images, targets)
 
             if self.task.SEG or self.task.MT:
                 images, targets = seg_data
                 images = self.to_device(images)
                 targets = self.to_device(targets)
-                seg_loss = self.seg_trainer.forward(images, targets)
+                images, targets = self.apply_batch_transform(self.seg_trainer.batch_transform, images, targets)
+                with self.optimizer.autocast():
+                    seg_loss = self.seg_trainer.forward(images, targets)
 
             if self.task.MT:
                 final_loss = loss_sum([cls_loss, seg_loss], CONFIG['loss_sum_weights'])
@@ -506,8 +935,28 @@ class MultiTaskTrainer(BaseTrainer):
             with self.optimizer.context() as opt:
                 # self.optimizer.update(final_loss)
                 opt.update(final_loss)
-
-        self.lr_scheduler.update()
+            self.lr_scheduler.update()
+
+        for dl in dataloaders:
+            self.log_data_time(dl)
+        self.log_profile()
+        self.cls_trainer.train_tracker.all_reduce()
+        self.seg_trainer.train_tracker.all_reduce()
+
+    def init_profiler(self) -> None:
+        super().init_profiler()
+        # forward/loss/metric stages are recorded by the task trainers
+        self.cls_trainer.profiler = self.profiler
+        self.seg_trainer.profiler = self.profiler
+
+    def steps_per_epoch(self) -> int:
+        # zip() stops at the shorter dataloader
+        lengths = []
+        if self.task.CLS or self.task.MT:
+            lengths.append(len(self.cls_trainer.train_dl))
+        if self.task.SEG or self.task.MT:
+            lengths.append(len(self.seg_trainer.train_dl))
+        return min(lengths)
 
     def val(self) -> None:
         self.model.eval()
@@ -517,18 +966,26 @@ class MultiTaskTrainer(BaseTrainer):
         if self.task.CLS or self.task.MT:
             self.cls_trainer.val()
 
-    def save_model(self) -> None:
-        save_dict = {
-            'epoch': self.epoch,
-            'state_dict': self.model.state_dict,
-            'model_name': self.model.model_name,
+    def val_metrics(self) -> Dict[str, float]:
+        metrics = {}
+        if self.task.CLS or self.task.MT:
+            metrics.update(self.cls_trainer.val_metrics())
+        if self.task.SEG or self.task.MT:
+            metrics.update(self.seg_trainer.val_metrics())
+        return metrics
+
+    def val_score(self, metrics: Dict[str, float]) -> Optional[float]:
+        # weighted top1 + miou
+        if 'top1' not in metrics or 'miou' not in metrics:
+            return None
+        weights = CONFIG['mt_metric_weights'] or [1, 1]
+        return weights[0] * metrics['top1'] + weights[1] * metrics['miou']
+
+    def checkpoint_meta(self) -> dict:
+        return {
             'num_classes': self.cls_trainer.labels.nc,
-            'mask_classes': self.seg_trainer.labels.nc,
-            'optimizer': convert_optimizer_state_dict_to_fp16(deepcopy(self.optimizer.state_dict())),
-            'lr': self.optimizer.lrs[0]
+            'mask_classes': self.seg_trainer.labels.nc
         }
-        save_path = os.path.join(CONFIG['weight_path'], f'epoch{self.epoch}.pth')
-        torch.save(save_dict, save_path)
 
 
 class Trainer:
@@ -543,26 +1000,37 @@ class Trainer:
 
         self.trainer.init_model()
         self.trainer.init_loss()
-        self.trainer.init_ds_dl()
+        self.trainer.init_ds()
         self.trainer.init_optimizer()
+        if CONFIG['autotune.enable']:
+            self.trainer.autotune()
+        self.trainer.init_dl()
+        self.trainer.init_ema()
+        self.trainer.init_profiler()
         self.trainer.init_lr_scheduler()
 
+        if CONFIG['resume']:
+            self.trainer.resume(CONFIG['resume'])
+
+        # The config this experiment actually runs with (autotune choices included)
+        if is_main_process():
+            save_yaml(CONFIG.metadata, os.path.join(CONFIG['experiment_path'], 'config.yaml'))
+
     def run(self) -> None:
         while self.trainer.epoch < CONFIG['epochs']:
+            metrics: Dict[str, float] = {}
             for mode in ['train', 'val']:
 
                 if mode == 'train':
                     self.trainer.train()
                     self.trainer.epoch += 1
-
-                    if self.trainer.epoch % CONFIG['save_period'] == 0:
-                        self.trainer.save_model()
                     log_metric('Epoch', self.trainer.epoch)
 
                 else:
                     if CONFIG['not_val'] is True:
                         continue
                     self.trainer.val()
+                    metrics = self.trainer.val_metrics()
 
                 lr: float = round8(self.trainer.optimizer.lrs[0]) if mode == 'train' else None
 
@@ -598,3 +1066,9 @@ class Trainer:
 
                 self.trainer.train_tracker.reset()
                 self.trainer.val_tracker.reset()
+
+            # Saved after val: best.pth follows this epoch's val metrics
+            if is_main_process():
+                self.trainer.save_model(metrics)
+
+        self.trainer.close()
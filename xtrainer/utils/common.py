@@ -10,6 +10,11 @@ import numpy as np
 from PIL import Image
 from colors import Colors
 
+try:
+    import orjson  # optional, faster json decoder
+except ImportError:
+    orjson = None
+
 
 def round4(data: float) -> float:
     assert isinstance(data, float)
@@ -27,6 +32,39 @@ def load_json(path: str):
     return data
 
 
+def _drop_image_data(raw: bytes) -> bytes:
+    # labelme embeds the whole image as a base64 string, cut it out before parsing.
+    # base64 has no quote or backslash, so the value ends at the next quote.
+    key = raw.rfind(b'"imageData"')
+    if key == -1:
+        return raw
+
+    colon = raw.find(b':', key + 11)
+    if colon == -1:
+        return raw
+
+    start = colon + 1
+    while raw[start:start + 1] in (b' ', b'\t', b'\r', b'\n'):
+        start += 1
+
+    if raw[start:start + 1] != b'"':  # null
+        return raw
+
+    end = raw.find(b'"', start + 1)
+    if end == -1:
+        return raw
+
+    return raw[:start] + b'null' + raw[end + 1:]
+
+
+def load_labelme_json(path: str) -> dict:
+    with open(path, 'rb') as f:
+        raw = _drop_image_data(f.read())
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
 def load_yaml(path: str):
     with open(path, encoding='utf-8') as f:
         data = yaml.load(f, Loader=yaml.FullLoader)
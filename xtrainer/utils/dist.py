@@ -0,0 +1,100 @@
+import os
+from functools import wraps
+from typing import Any, Callable
+
+import torch
+import torch.distributed as dist
+
+# Distributed data parallel helpers, the process group comes from torchrun env (RANK, WORLD_SIZE, LOCAL_RANK...)
+# Every helper falls back to the single process behaviour when no process group is initialized.
+
+__all__ = [
+    'is_dist',
+    'get_rank',
+    'get_local_rank',
+    'get_world_size',
+    'is_main_process',
+    'init_distributed',
+    'destroy_distributed',
+    'barrier',
+    'all_reduce_sum',
+    'broadcast_object',
+    'main_process_only'
+]
+
+
+def is_dist() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_dist() else 0
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_dist() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(use_cuda: bool) -> bool:
+    # Only when launched by torchrun with more than one process
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1 or is_dist():
+        return is_dist()
+
+    if use_cuda:
+        torch.cuda.set_device(get_local_rank())
+
+    backend = 'nccl' if use_cuda else 'gloo'
+    dist.init_process_group(backend=backend)
+    return True
+
+
+def destroy_distributed() -> None:
+    if is_dist():
+        dist.destroy_process_group()
+
+
+def barrier() -> None:
+    if is_dist():
+        dist.barrier()
+
+
+def all_reduce_sum(data: torch.Tensor) -> torch.Tensor:
+    if not is_dist():
+        return data
+
+    # nccl only reduces cuda tensors
+    device = data.device
+    if dist.get_backend() == 'nccl' and not data.is_cuda:
+        data = data.cuda(torch.cuda.current_device())
+    else:
+        data = data.clone()
+
+    dist.all_reduce(data, op=dist.ReduceOp.SUM)
+    return data.to(device)
+
+
+def broadcast_object(obj: Any, src: int = 0) -> Any:
+    if not is_dist():
+        return obj
+
+    objects = [obj if get_rank() == src else None]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def main_process_only(func: Callable) -> Callable:
+    @wraps(func)
+    def func_wrapper(*args, **kwargs):
+        if is_main_process():
+            return func(*args, **kwargs)
+        return None
+
+    return func_wrapper
@@ -1,7 +1,6 @@
-import numpy as np
-
-from typing import List, Union, Optional
+from typing import List, Union, Optional, NamedTuple
 from dataclasses import dataclass
+import numpy as np
 
 
 class Labels:
@@ -36,18 +35,25 @@ class Labels:
             raise TypeError("输入必须是整数或字符串")
 
 
+class Shape(NamedTuple):
+    label: str
+    points: np.ndarray  # (N,2) float64 [[x,y],[x,y],...]
+
+
 # only support labelme format
 class MaskLabel:
     def __init__(self, metadata: Optional[dict] = None):
 
         self.metadata: Optional[dict] = None
-        self.objects: Optional[list] = None
+        self.path: Optional[str] = ''  # json path
+        self.mtime: Optional[int] = 0  # json st_mtime_ns when loaded
+        self.objects: Optional[List[Shape]] = None
         self.image_path: Optional[str] = ''
         self.num_objects: Optional[int] = 0
         self.is_background: Optional[int] = False
         self.ih: Optional[int] = 0
         self.iw: Optional[int] = 0
-        self.mask: Optional[np.ndarray] = None
+        self.mask = None  # RLEMask when the dataset is cached
 
         if metadata is not None:
             self.metadata = metadata
@@ -59,11 +65,15 @@ class MaskLabel:
 
     def _decode(self) -> None:
         if self.metadata is not None:
-            self.objects = self.metadata.get('shapes')
+            # Keep only what the mask needs, the raw json is dropped after decoding
+            self.objects = [
+                Shape(obj['label'], np.asarray(obj['points'], dtype=np.float64))
+                for obj in self.metadata.get('shapes') or []
+            ]
             self.image_path = self.metadata.get('imagePath')
             self.iw = self.metadata.get('imageWidth')
             self.ih = self.metadata.get('imageHeight')
 
             self.num_objects = len(self.objects)
             self.is_background = self.num_objects == 0
-            self.metadata['imageData'] = None
+            self.metadata = None
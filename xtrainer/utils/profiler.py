@@ -0,0 +1,206 @@
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Optional, Dict, List, Iterable, Iterator, Any, Union
+
+import numpy as np
+import torch
+from loguru import logger
+
+__all__ = ['StepProfiler', 'STAGES']
+
+STAGES = ['data', 'h2d', 'forward', 'loss', 'backward', 'optimizer', 'metric', 'log']
+
+_NULL = nullcontext()
+
+
+class StepProfiler:
+    """
+    Per step timing of the train loop stages, summarized (percentiles) once per epoch.
+        data: host time blocked on the dataloader (the prefetcher wait)
+        other stages: cuda events on gpu (no per step synchronize, resolved once completed), wall time on cpu
+    trace: a torch.profiler chrome trace of steps [trace_start, trace_start + trace_steps) of the first epoch.
+    Disabled: stage() returns a shared nullcontext, nothing is recorded.
+    """
+
+    def __init__(
+        self,
+        device: Union[str, torch.device],
+        enabled: Optional[bool] = False,
+        trace: Optional[bool] = False,
+        trace_start: Optional[int] = 10,
+        trace_steps: Optional[int] = 5,
+        trace_dir: Optional[str] = None
+    ) -> None:
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.use_cuda = enabled and self.device.type == 'cuda'
+
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self._trace = enabled and trace
+        self._torch_profiler: Optional[torch.profiler.profile] = None
+
+        self.times: Dict[str, List[float]] = {}  # stage -> ms per step
+        self.step_times: List[float] = []  # wall ms per step
+        self._pending: List[tuple] = []  # (stage, start event, end event)
+        self._free_events: List[torch.cuda.Event] = []
+        self._step_begin = 0.0
+        self._step = 0
+
+    def _event(self) -> torch.cuda.Event:
+        if self._free_events:
+            return self._free_events.pop()
+        return torch.cuda.Event(enable_timing=True)
+
+    def _add(self, name: str, ms: float) -> None:
+        self.times.setdefault(name, []).append(ms)
+
+    @contextmanager
+    def _cpu_stage(self, name: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        yield
+        self._add(name, (time.perf_counter() - t0) * 1000)
+
+    @contextmanager
+    def _cuda_stage(self, name: str) -> Iterator[None]:
+        start = self._event()
+        end = self._event()
+        start.record()
+        yield
+        end.record()
+        self._pending.append((name, start, end))
+
+    def stage(self, name: str, cpu: Optional[bool] = False):
+        if not self.enabled:
+            return _NULL
+        if self.use_cuda and not cpu:
+            return self._cuda_stage(name)
+        return self._cpu_stage(name)
+
+    def _resolve(self, wait: bool = False) -> None:
+        # Events are completed in record order, stop at the first one still running
+        if wait and self._pending:
+            self._pending[-1][2].synchronize()
+
+        done = 0
+        for name, start, end in self._pending:
+            if not end.query():
+                break
+            self._add(name, start.elapsed_time(end))
+            self._free_events.extend((start, end))
+            done += 1
+        del self._pending[:done]
+
+    def _start_trace(self) -> None:
+        from torch.profiler import profile, schedule, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(ProfilerActivity.CUDA)
+
+        path = os.path.join(
+            self.trace_dir or '.',
+            f'trace_step{self.trace_start}-{self.trace_start + self.trace_steps}.json'
+        )
+
+        def on_trace_ready(prof: profile) -> None:
+            prof.export_chrome_trace(path)
+            logger.info(f'Profiler chrome trace: {path}')
+
+        self._torch_profiler = profile(
+            activities=activities,
+            schedule=schedule(wait=max(self.trace_start - 1, 0), warmup=1, active=self.trace_steps, repeat=1),
+            on_trace_ready=on_trace_ready,
+            record_shapes=True
+        )
+        self._torch_profiler.start()
+
+    def _stop_trace(self) -> None:
+        if self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self._torch_profiler = None
+            self._trace = False  # only one window per run
+
+    def start_epoch(self) -> None:
+        self.times = {}
+        self.step_times = []
+        self._pending = []
+        self._step = 0
+        if self._trace:
+            self._start_trace()
+        self._step_begin = time.perf_counter()
+
+    def step(self) -> None:
+        now = time.perf_counter()
+        self.step_times.append((now - self._step_begin) * 1000)
+        self._step_begin = now
+        self._step += 1
+
+        if self.use_cuda:
+            self._resolve()
+
+        if self._torch_profiler is not None:
+            self._torch_profiler.step()
+            if self._step >= self.trace_start + self.trace_steps:
+                self._stop_trace()
+
+    def iter(self, iterable: Iterable) -> Iterator[Any]:
+        # Times the dataloader next() as 'data', one step() per loop body
+        if not self.enabled:
+            yield from iterable
+            return
+
+        self.start_epoch()
+        it = iter(iterable)
+        try:
+            while True:
+                with self.stage('data', cpu=True):
+                    try:
+                        data = next(it)
+                    except StopIteration:
+                        return
+                yield data
+                self.step()
+        finally:
+            self._stop_trace()
+
+    def summary(self) -> str:
+        if not self.enabled or not self.step_times:
+            return ''
+
+        if self.use_cuda:
+            self._resolve(wait=True)
+
+        step_total = float(np.sum(self.step_times))
+        lines = [
+            f'Step profile: {len(self.step_times)} steps, '
+            f'step ms p50={np.percentile(self.step_times, 50):.2f} p90={np.percentile(self.step_times, 90):.2f} '
+            f'p99={np.percentile(self.step_times, 99):.2f}',
+            f'{"stage":<10}{"mean":>9}{"p50":>9}{"p90":>9}{"p99":>9}{"share":>8}'
+        ]
+        for name in STAGES + [k for k in self.times if k not in STAGES]:
+            values = self.times.get(name)
+            if not values:
+                continue
+            share = np.sum(values) / step_total * 100 if step_total > 0 else 0.0
+            lines.append(
+                f'{name:<10}{np.mean(values):>9.2f}{np.percentile(values, 50):>9.2f}'
+                f'{np.percentile(values, 90):>9.2f}{np.percentile(values, 99):>9.2f}{share:>7.1f}%'
+            )
+
+        data_share = np.sum(self.times.get('data', [0.0])) / step_total * 100 if step_total > 0 else 0.0
+        bound = 'input-bound' if data_share >= 20 else 'compute-bound'
+        lines.append(f'Waiting for data: {data_share:.1f}% of the step time => {bound}.')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    profiler = StepProfiler('cpu', enabled=True)
+    for _ in profiler.iter(range(20)):
+        with profiler.stage('forward'):
+            time.sleep(0.002)
+        with profiler.stage('backward'):
+            time.sleep(0.004)
+    print(profiler.summary())
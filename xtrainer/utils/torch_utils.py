@@ -1,5 +1,5 @@
 import random
-from typing import List
+from typing import List, Optional
 import numpy as np
 import torch
 import torch.backends.cudnn
@@ -20,6 +20,17 @@ def init_backends_cudnn(deterministic: bool = False) -> None:
         torch.backends.cudnn.benchmark = False
 
 
+def get_memory_format(name: Optional[str] = 'contiguous') -> torch.memory_format:
+    memory_formats = {
+        'contiguous': torch.contiguous_format,
+        'channels_last': torch.channels_last
+    }
+    name = 'contiguous' if name is None else name
+    if name not in memory_formats:
+        raise ValueError(f'memory_format must be in {list(memory_formats.keys())}, but got {name}')
+    return memory_formats[name]
+
+
 def convert_optimizer_state_dict_to_fp16(state_dict) -> dict:
     for state in state_dict["state"].values():
         for k, v in state.items():
@@ -29,6 +40,33 @@ def convert_optimizer_state_dict_to_fp16(state_dict) -> dict:
     return state_dict
 
 
+def convert_optimizer_state_dict_to_fp32(state_dict) -> dict:
+    # Undo convert_optimizer_state_dict_to_fp16 before resuming
+    for state in state_dict["state"].values():
+        for k, v in state.items():
+            if k != "step" and isinstance(v, torch.Tensor) and v.dtype is torch.float16:
+                state[k] = v.float()
+
+    return state_dict
+
+
+def get_rng_state() -> dict:
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    }
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
 def loss_sum(losses: List[torch.Tensor], weights: List[float]) -> torch.Tensor:
     assert len(losses) == len(weights), 'len(loss)!=len(weights)'
 
@@ -41,9 +79,10 @@ def loss_sum(losses: List[torch.Tensor], weights: List[float]) -> torch.Tensor:
 
 
 class ToDevice:
-    def __init__(self, device: int = -1):
+    def __init__(self, device: int = -1, memory_format: Optional[torch.memory_format] = torch.contiguous_format):
         self.device = torch.device('cpu')
         self.is_gpu = False
+        self.memory_format = memory_format
 
         if torch.cuda.is_available() or device >= 0:
             self.device = torch.device(f'cuda:{device}')
@@ -51,6 +90,10 @@ class ToDevice:
 
     def __call__(self, data: torch.Tensor) -> torch.Tensor:
         if self.is_gpu:
-            return data.cuda(self.device, non_blocking=True)
-        else:
-            return data
+            data = data.cuda(self.device, non_blocking=True)
+
+        # Only images (N,C,H,W) follow the model memory format
+        if data.dim() == 4 and data.is_floating_point():
+            data = data.contiguous(memory_format=self.memory_format)
+
+        return data
@@ -1,4 +1,7 @@
 import numpy as np
+import torch
+
+from xtrainer.utils.dist import is_dist, all_reduce_sum
 
 
 class DataTracker:
@@ -6,10 +9,21 @@ class DataTracker:
         self.name = name
         self._metadata = []
         self._val: float = 0.0
+        self._global = None  # (sum,size) of all ranks after all_reduce()
 
     def reset(self) -> None:
         self._metadata = []
         self._val = 0.0
+        self._global = None
+
+    def all_reduce(self) -> None:
+        # Distributed: merge the values of every rank, sum/avg/size then cover all ranks.
+        # Every rank must call it (collective op).
+        if not is_dist():
+            return
+        local = torch.tensor([float(np.sum(self._metadata)), len(self._metadata)], dtype=torch.float64)
+        total = all_reduce_sum(local)
+        self._global = (float(total[0]), int(total[1]))
 
     def add(self, val) -> None:
         self._metadata.append(val)
@@ -17,6 +31,8 @@ class DataTracker:
 
     @property
     def size(self) -> int:
+        if self._global is not None:
+            return self._global[1]
         return len(self._metadata)
 
     @property
@@ -25,10 +41,14 @@ class DataTracker:
 
     @property
     def sum(self) -> float:
+        if self._global is not None:
+            return self._global[0]
         return float(np.sum(self._metadata))
 
     @property
     def avg(self) -> float:
+        if self._global is not None:
+            return self._global[0] / max(self._global[1], 1)
         return float(np.mean(self._metadata))
 
     @property
@@ -51,6 +71,11 @@ class ClsTrainTracker:
         self.topk.reset()
         self.loss.reset()
 
+    def all_reduce(self) -> None:
+        self.top1.all_reduce()
+        self.topk.all_reduce()
+        self.loss.all_reduce()
+
 
 class ClsValTracker:
     def __init__(self, name: str = 'ValTracker', topk: int = 2):  # noqa
@@ -64,6 +89,11 @@ class ClsValTracker:
         self.topk.reset()
         self.loss.reset()
 
+    def all_reduce(self) -> None:
+        self.top1.all_reduce()
+        self.topk.all_reduce()
+        self.loss.all_reduce()
+
 
 class SegTrainTracker:
     def __init__(self, name: str = 'Segmentation Train Tracker', topk: int = 2):  # noqa
@@ -75,6 +105,10 @@ class SegTrainTracker:
         self.miou.reset()
         self.loss.reset()
 
+    def all_reduce(self) -> None:
+        self.miou.all_reduce()
+        self.loss.all_reduce()
+
 
 class SegValTracker:
     def __init__(self, name: str = 'Segmentation Val Tracker', topk: int = 2):  # noqa
@@ -85,3 +119,7 @@ class SegValTracker:
     def reset(self) -> None:
         self.miou.reset()
         self.loss.reset()
+
+    def all_reduce(self) -> None:
+        self.miou.all_reduce()
+        self.loss.all_reduce()